@@ -6,18 +6,59 @@
 # @Desc  : 调用AWS EC2服务，启停机、摘挂盘，创建盘
 #
 
+import collections
+import copy
+import threading
 import time
 import boto3
+from botocore.config import Config
 import config as cfg
+import inventory
+import journal
+import throttle
+import timeline
+import waiter
 
 client_ec2 = None
 ec2 = None
 
+# 注册新AMI时沿用的原AMI属性，Describe与RegisterImage同名
+ImageAttributes = ['Architecture', 'RootDeviceName', 'VirtualizationType', 'EnaSupport', 'SriovNetSupport',
+                   'BootMode', 'TpmSupport', 'ImdsSupport', 'KernelId', 'RamdiskId']
+images_lock = threading.Lock()
+registering = set()  # 已开始注册新AMI的原AMI ID
+registrations = []  # 注册新AMI的线程
 
-def setup():
+
+# 建EC2客户端，连接池按同时缩容的磁盘数确定，每块盘的线程之外还有轮询线程和主线程
+def setup(workers=0):
     global client_ec2, ec2
-    client_ec2 = boto3.client('ec2')
-    ec2 = boto3.resource('ec2')
+    throttle.setup()
+    config = Config(retries=dict(mode='adaptive', max_attempts=cfg.ApiAttempts),
+                    max_pool_connections=max(10, workers + 2))
+    session = boto3.session.Session()
+    client_ec2 = session.client('ec2', config=config)
+    ec2 = session.resource('ec2', config=config)
+    throttle.register(client_ec2)
+    throttle.register(ec2.meta.client)
+
+
+# 本机已用设备名，以及还能挂载的EBS盘数量
+def attachment_capacity():
+    """
+    :return: (used_devices, free_attachments)
+    """
+    self = ec2.Instance(cfg.instance['instanceId'])
+    used = [mapping['DeviceName'] for mapping in self.block_device_mappings]
+    info = client_ec2.describe_instance_types(InstanceTypes=[cfg.instance['instanceType']])['InstanceTypes'][0]
+    limit = info.get('EbsInfo', {}).get('MaximumEbsAttachments', 0)  # 有专用EBS挂载上限的机型
+    if limit:
+        return used, limit - len(used)
+    if info.get('Hypervisor', '') != 'nitro':
+        return used, 40 - len(used)
+    # nitro机型网卡、EBS盘和本地NVMe盘共用28个挂载位
+    disks = sum(disk['Count'] for disk in info.get('InstanceStorageInfo', {}).get('Disks', []))
+    return used, 28 - len(self.network_interfaces_attribute) - disks - len(used)
 
 
 #
@@ -27,14 +68,80 @@ def get_images():
     return images
 
 
-# 把AMI目标机启动为虚机，以获取其磁盘
-def image2instance(image_id):
-    instances = ec2.create_instances(ImageId=image_id, InstanceType='t3.micro', MaxCount=1, MinCount=1,
-                                     Placement={'AvailabilityZone': cfg.instance['availabilityZone']})
-    instance = instances[0]
-    instance.create_tags(Tags=[dict(Key='Name', Value='tmp4shrinking'), dict(Key='Project', Value='ShrinkVolume')])
-    instance.wait_until_running()
-    return instance
+# AMI各EBS盘的快照直接异步恢复为盘，不启动临时实例
+def image2volumes(image):
+    """
+    :return: [dict(origin=volume, image=image, dev=DeviceName)]，未列出的盘注册新AMI时沿用原快照
+    """
+    volumes = []
+    for mapping in image.block_device_mappings:
+        ebs, dev = mapping.get('Ebs', {}), mapping['DeviceName']
+        if not ebs.get('SnapshotId', ''):
+            continue
+        size = ebs.get('VolumeSize', 0)
+        if size < cfg.MinVolumeSize:  # 太小的盘缩容意义不大
+            continue
+        if 'a' in dev and 'b' in cfg.args.omit:  # 系统盘
+            continue
+        if ebs.get('VolumeType', '') in ['sc1', 'st1'] and size < 500:  # 最小为500G，再缩没有意义
+            continue
+        volumes.append(dict(origin=restore_volume(ec2.Snapshot(ebs['SnapshotId'])), image=image, dev=dev))
+    return volumes
+
+
+# AMI的一块盘完成：新盘做快照；同一AMI的盘都完成后，在单独线程中注册新AMI
+def image_done(volume):
+    image = volume['image']
+    try:
+        if volume['result'] == volume.get('dup', ''):
+            volume['shrunk'] = volume['dup'].create_snapshot(
+                Description='Shrunk %s of %s' % (volume['dev'], image.id),
+                TagSpecifications=[dict(ResourceType='snapshot', Tags=[dict(Key='Project', Value='ShrinkVolume')])])
+    except Exception as err:  # 该盘按未缩容处理，新AMI沿用原快照
+        cfg.log.exception(err)
+    volume['imaged'] = True
+    with images_lock:
+        volumes = [v for v in cfg.volumeRepository if v.get('image', '') == image]
+        if image.id in registering or not all(v.get('imaged', False) for v in volumes):
+            return
+        registering.add(image.id)
+    thread = threading.Thread(target=register_image, args=(image, volumes), name='register-%s' % image.id)
+    registrations.append(thread)
+    thread.start()
+
+
+# 用缩容后的快照注册新AMI，属性、标签与原AMI相同，原AMI保留
+def register_image(image, volumes):
+    shrunk = {v['dev']: v for v in volumes if v.get('shrunk', '')}
+    if not shrunk:
+        cfg.log.info('[NoShrink]%s' % image.id)
+        return
+    try:
+        for v in shrunk.values():
+            if not waiter.wait_snapshot(v['shrunk'], waiter.snapshot_state('completed')):
+                raise UserWarning('snapshot %s Time out' % v['shrunk'].id)
+        mappings = copy.deepcopy(image.block_device_mappings)
+        for mapping in mappings:
+            v = shrunk.get(mapping['DeviceName'], None)
+            if v and 'Ebs' in mapping:
+                mapping['Ebs'].update(SnapshotId=v['shrunk'].id, VolumeSize=v['dup'].size)
+                mapping['Ebs'].pop('Encrypted', None)  # 由快照决定
+                mapping['Ebs'].pop('KmsKeyId', None)
+        attributes = {k: image.meta.data[k] for k in ImageAttributes if image.meta.data.get(k, '')}
+        name = '%s-shrunk-%s' % (image.name[:100], time.strftime('%Y%m%d%H%M%S'))
+        new = ec2.register_image(Name=name, Description='Shrunk from %s' % image.id,
+                                 BlockDeviceMappings=mappings, **attributes)
+        tags = [t for t in image.tags or [] if not t['Key'].startswith('aws:')]
+        new.create_tags(Tags=tags + [dict(Key='ShrinkFrom', Value=image.id), dict(Key='Project', Value='ShrinkVolume')])
+        cfg.log.info('[SUCCESS]%s(%s) registered for %s' % (new.id, name, image.id))
+    except Exception as err:
+        cfg.log.error('[FAILED]%s failed to register: %s' % (image.id, err))
+        for v in shrunk.values():
+            v['shrunk'].delete()
+    finally:  # 数据已在快照中，删除新盘
+        for v in shrunk.values():
+            detach__volume(v['dup'])
+            v['dup'].delete()
 
 
 # 获取本机所在AZ、指定tag的实例列表
@@ -43,8 +150,7 @@ def get_instances(same_az=True):
     if same_az:
         f.append({'Name': 'availability-zone', 'Values': [cfg.instance['availabilityZone'], ]})
     f += cfg.args.filters
-    instances = ec2.instances.filter(Filters=f)
-    return instances
+    return inventory.get_instances(f)  # 同时批量预取各实例的磁盘
 
 
 #  获取指定实例、需缩容的磁盘列表
@@ -58,7 +164,7 @@ def get_instance_volumes(instance):
     ]
     """
     volumes = []
-    for volume in instance.volumes.all():
+    for volume in inventory.get_volumes(instance):
         if volume.size < cfg.MinVolumeSize:  # 太小的盘缩容意义不大
             continue
         if 'a' in volume.attachments[0]['Device']:  # 系统盘
@@ -74,6 +180,11 @@ def get_instance_volumes(instance):
 # 从虚机摘除多个EBS盘
 def detach_volumes(volumes, tags=None):
     tags = [] if not tags else tags
+    with timeline.span('detach', instance=','.join(set(v['instance'].id for v in volumes))):
+        _detach_volumes(volumes, tags)
+
+
+def _detach_volumes(volumes, tags):
     for v in volumes:
         upwt = '%s,%sGib,%s,IOPS:%s' % \
                (v['instance'].id, v['origin'].size, v['origin'].volume_type, v['origin'].iops)
@@ -81,7 +192,6 @@ def detach_volumes(volumes, tags=None):
         v['origin'].detach_from_instance()
         cfg.log.info(' %s detached from the %s %s(%s) for shrinking...' %
                      (v['origin'].id, v['state'], v['instance'].id, v['dev']))
-    time.sleep(3)
 
 
 # 停掉运行的虚机
@@ -91,12 +201,10 @@ def stop_instance(instance, interactive=False):
         if input('%s is %s, Stop it for shrinking? <Y>  ' % (instance.id, state)) not in cfg.YES:
             print('shrink for %s is skipped...\n' % instance.id)
             return False
-    instance.stop()
-    # 等待完成停机
-    try:
-        instance.wait_until_stopped()
-    except Exception:
-        pass
+    timeline.down(instance.id)
+    with timeline.span('stop', instance=instance.id):
+        instance.stop()
+        waiter.wait_instance(instance, waiter.instance_state('stopped'))  # 等待完成停机
     if instance.state['Name'] != 'stopped':
         cfg.log.warning('Unable to stop %s, Ignoring...' % instance.id)
         return False
@@ -104,6 +212,7 @@ def stop_instance(instance, interactive=False):
 
 
 # 创建EBS盘, 其他可变参数可以直接传递进来
+@timeline.span('create_volume')
 def create_volume(VolumeType='gp2', **argv):
     parameters = {k: v for k, v in argv.items() if v}
     size = parameters.get('Size', 0)
@@ -115,66 +224,185 @@ def create_volume(VolumeType='gp2', **argv):
     parameters['AvailabilityZone'] = cfg.instance['availabilityZone']
 
     volume = ec2.create_volume(**parameters)
-
-    for i in range(cfg.TIMEOUT):
-        volume.load()
-        if volume.state == 'available':
-            break
-        time.sleep(1)
-    else:
+    if not waiter.wait_volume(volume, waiter.volume_state('available')):
         raise UserWarning('Time out')
     cfg.log.info('%s Created. %s' % (volume.id, parameters))
     return volume
 
 
+# 复制期间新盘的临时性能：gp3，IOPS每GB最多500，吞吐每IOPS最多0.25MB/s，不低于gp3基准
+def boost_settings(size):
+    iops = max(3000, min(cfg.BoostIops, 500 * size))
+    return dict(VolumeType='gp3', Iops=iops, Throughput=max(125, min(cfg.BoostThroughput, iops // 4)))
+
+
+# 新盘最终的类型和性能，沿用原盘的预置IOPS和吞吐，按新盘大小限制在允许范围内
+def performance(origin, size):
+    """
+    :param origin: 原盘
+    :param size: 新盘大小(GB)
+    :return: dict(VolumeType=, Iops=, Throughput=)，create_volume/modify_volume的参数
+    """
+    settings = dict(VolumeType=origin.volume_type)
+    if origin.volume_type == 'gp3':  # gp3每GB最多500 IOPS，每IOPS最多0.25MB/s，不低于基准3000/125
+        settings['Iops'] = max(3000, min(origin.iops or 0, 500 * size))
+        settings['Throughput'] = max(125, min(origin.throughput or 0, settings['Iops'] // 4))
+    elif origin.volume_type in ('io1', 'io2'):  # 每GB最多io1 50、io2 500 IOPS
+        settings['Iops'] = max(100, min(origin.iops, (50 if origin.volume_type == 'io1' else 500) * size))
+    return settings
+
+
+# 复制完成，新盘改回最终的类型和性能，改动在后台进行，不影响挂回使用
+def unboost(volume):
+    dup, final = volume['dup'], volume.pop('boost')
+    parameters = {k: v for k, v in final.items() if v}
+    client_ec2.modify_volume(VolumeId=dup.id, **parameters)
+    dup.create_tags(Tags=[dict(Key='ShrinkBoost', Value='%s -> %s' % (boost_tag(boost_settings(dup.size)),
+                                                                      boost_tag(parameters)))])
+    cfg.log.info('%s modifying back to %s after copy' % (dup.id, parameters))
+
+
+def boost_tag(settings):
+    return ','.join('%s:%s' % (k, v) for k, v in sorted(settings.items()))
+
+
 # 从EC2拆离EBS盘
 def detach__volume(volume):
     volume.load()
-    if volume.state == 'in-use':
+    if volume.state == 'in-use' and volume.attachments[0]['State'] != 'detaching':
         volume.detach_from_instance()  # 先尝试卸下
-    for i in range(cfg.TIMEOUT):
-        volume.load()
-        if volume.state == 'available':
-            return True
-        time.sleep(1)
-    else:
-        return False
+    return waiter.wait_volume(volume, waiter.volume_state('available'))
 
 
 # 磁盘挂到EC2
 def attach_volume(volume, device, instance_id):
+    with timeline.span('attach' if instance_id == cfg.instance['instanceId'] else 'reattach', device=device):
+        _attach_volume(volume, device, instance_id)
+
+
+def _attach_volume(volume, device, instance_id):
     detach__volume(volume)  # 先尝试卸下
     volume.attach_to_instance(Device=device, InstanceId=instance_id)
-    for i in range(cfg.TIMEOUT):
-        volume.load()
-        if volume.attachments and volume.attachments[0]['State'] == 'attached':
-            break
-        time.sleep(1)
-    else:
+    if not waiter.wait_volume(volume, waiter.volume_attached):
         raise UserWarning('attach %s Time out' % volume.id)
     msg = 'shrinking' if instance_id == cfg.instance['instanceId'] else 'original'
     cfg.log.info('%s attached to the %s server: %s%s.' % (volume.id, msg, instance_id, device))
-    time.sleep(3)
+
+
+# 盘是否仍以该设备名挂在实例上，盘已删除时为否
+def attached_to(volume_id, instance_id, device):
+    try:
+        volume = ec2.Volume(volume_id)
+        volume.load()
+    except Exception:
+        return False
+    return any(a['InstanceId'] == instance_id and a['Device'] == device and a['State'] in ('attaching', 'attached')
+               for a in volume.attachments)
+
+
+# 两阶段缩容：在原机运行时给原盘做快照并恢复成临时盘，先用它复制全量
+@timeline.span('seed')
+def seed_volume(volume):
+    origin = volume['origin']
+    snapshot = origin.create_snapshot(Description='Seed for shrinking %s' % origin.id,
+                                      TagSpecifications=[dict(ResourceType='snapshot', Tags=[
+                                          dict(Key='Project', Value='ShrinkVolume')])])
+    volume['snapshot'] = snapshot
+    if not waiter.wait_snapshot(snapshot, waiter.snapshot_state('completed')):
+        raise UserWarning('snapshot %s Time out' % snapshot.id)
+    seed = volume['seed'] = restore_volume(snapshot)  # 先记下，超时等失败时由drop_seed删除
+    wait_restored(volume, 'seed')
+    cfg.log.info('%s seeded from %s(%s) while %s keeps running' % (seed.id, origin.id, snapshot.id, volume['instance'].id))
+
+
+# 删除两阶段缩容的临时盘和快照
+def drop_seed(volume):
+    seed, snapshot = volume.pop('seed', None), volume.pop('snapshot', None)
+    if seed:
+        detach__volume(seed)
+        seed.delete()
+        if volume.get('source', '') == seed:
+            volume['source'] = None
+    if snapshot:
+        snapshot.delete()
+
+
+# 删除续做时不再使用的新盘
+def drop_dup(volume):
+    dup = volume.pop('dup', None)
+    if dup:
+        detach__volume(dup)
+        dup.delete()
+        cfg.log.info('%s(dup of %s) deleted' % (dup.id, volume['origin'].id))
+
+
+# 两阶段缩容的停机点，由同机最后一块完成全量复制的盘执行：停机，摘下需同步增量的原盘
+def stop_for_delta(instance, volumes):
+    todo = [v for v in volumes if not v.get('result', '')]
+    if not todo:
+        return
+    for v in todo:  # 停机、摘盘过程中中断的，续做时恢复原机
+        journal.save(v, 'stopping')
+    if not stop_instance(instance, interactive=False):
+        cfg.log.error('[FAILED]%s failed to stop, ignore shrinking...' % instance.id)
+        return
+    detach_volumes(todo)
+    for v in todo:
+        v['detached'] = True
+        journal.save(v)
+
+
+# 停机摘盘过程中中断：原盘挂回仍未挂上的，原来在运行的实例重新启动
+def recover_stopping(instance, volumes):
+    instance.load()
+    if instance.state['Name'] in ('pending', 'stopping'):
+        waiter.wait_instance(instance, lambda data: data['State']['Name'] in ('running', 'stopped'), cfg.InstanceTimeout)
+        instance.load()
+    for v in volumes:
+        v['origin'].load()
+        if not any(a['InstanceId'] == instance.id for a in v['origin'].attachments):
+            attach_volume(v['origin'], v['dev'], instance.id)
+    if instance.state['Name'] == 'stopped' and any(v['state'] in ('pending', 'running') for v in volumes):
+        start_instance(instance, no_check=True)
+    cfg.log.info('%s recovered from an interrupted stop with %s' % (instance.id, [v['origin'].id for v in volumes]))
+
+
+# 两阶段缩容：全量复制后换掉临时盘，等同机各盘都到停机点后，把原盘挂到本机同一设备上
+def swap_seed(volume, device):
+    drop_seed(volume)
+    volume.pop('barrier').wait()
+    if not volume['detached']:  # 原机未能停机
+        return False
+    attach_volume(volume['origin'], device, cfg.instance['instanceId'])
+    volume['source'] = volume['origin']
+    return True
 
 
 # 完成1块盘缩容后的收尾工作 EC2上的新盘或原盘挂回，按需启动
-def wind_up(idx_repository):
-    volume = cfg.volumeRepository[idx_repository]
+def wind_up(volume):
     if not volume.get('result', ''):  # 本磁盘没有完成，恢复
         volume['result'] = volume['origin']
+    drop_seed(volume)
     instance = volume.get('instance', '')
-    if not instance:  # 快照缩容，删掉原临时volume
-        if volume['result'] == volume['dup']:  # 快照缩容成功
-            cfg.log.info('[SUCCESS]%s for %s(Snapshot)' % (volume['dup'].id, volume['origin'].snapshot_id))
-        else:  # 缩容失败，删除目标盘
-            cfg.log.info('[FAILED]%s for %s(Snapshot)' % (volume['origin'].id, volume['origin'].snapshot_id))
-            if volume.get('dup', ''):
-                volume['dup'].delete()
-        volume['origin'].delete()
+    if not instance:  # 快照/AMI缩容，摘下并删掉原临时volume
+        kind = 'AMI %s' % volume['image'].id if volume.get('image', '') else 'Snapshot'
+        try:
+            if volume['result'] == volume.get('dup', ''):  # 快照缩容成功
+                cfg.log.info('[SUCCESS]%s for %s(%s)' % (volume['dup'].id, volume['origin'].snapshot_id, kind))
+            else:  # 未缩容(含用量过高、建新盘前失败)，删除目标盘
+                cfg.log.info('[FAILED]%s for %s(%s)' % (volume['origin'].id, volume['origin'].snapshot_id, kind))
+                drop_dup(volume)
+            detach__volume(volume['origin'])  # 立即摘下，以免本机设备名归还后仍被占用
+            volume['origin'].delete()
+        finally:  # 即使清理失败，同一AMI的其他盘也要能注册新AMI
+            journal.finish(volume)
+            image_done(volume) if volume.get('image', '') else None
         return
 
-    # EC2/AMI缩容，磁盘挂回，启动测试
-    attach_volume(volume['result'], volume['dev'], instance.id)
+    # EC2缩容，磁盘挂回，启动测试
+    if volume.get('detached', True):  # 两阶段缩容未到停机点的，原盘仍在原机上
+        attach_volume(volume['result'], volume['dev'], instance.id)
+    journal.finish(volume)
     if volume['state'] not in ['pending', 'running']:
         return  # 缩容前原机本就未启动，不做启动测试
     volumes = [v for v in cfg.volumeRepository if v.get('instance', '') == volume['instance']]
@@ -191,9 +419,18 @@ def start_instance(instance, no_check=False):
     instance.start()
     cfg.log.info('%s starting...' % instance.id)
     if no_check:
+        timeline.up(instance.id)
         return True
 
-    instance.wait_until_running()
+    with timeline.span('boot_check', instance=instance.id):
+        started = check_instance(instance)
+    timeline.up(instance.id)
+    return started
+
+
+# 等待EC2启动并通过状态检查
+def check_instance(instance):
+    waiter.wait_instance(instance, waiter.instance_state('running'))
     for i in range(cfg.TIMEOUT):
         r = client_ec2.describe_instance_status(InstanceIds=[instance.id])
         if r['InstanceStatuses'][0]['InstanceStatus']['Status'] == 'ok':
@@ -215,70 +452,39 @@ def restore_instance(instance):
     start_instance(instance, no_check=True)  # 启动原机
 
 
-# 返回具有指定tag的快照列表
+# 逐个恢复具有指定tag的快照，异步建盘，只比消费者多恢复cfg.LookAhead块
 def snapshot2volume():
+    """
+    :return: 生成器，dict(origin=volume)，盘可能尚未可用，由缩容线程wait_restored
+    """
     snapshots = ec2.snapshots.filter(Filters=cfg.args.filters + [{'Name': 'status', 'Values': ['completed']}])
-    volumes = []
+    pending = collections.deque()
     for snapshot in snapshots:
-        volume = create_volume('gp2', SnapshotId=snapshot.id)
-        volume.create_tags(Tags=[dict(Key='Origin', Value=snapshot.id),
-                                 dict(Key='Project', Value='ShrinkVolume')])
-        volumes.append(dict(origin=volume))
-    return volumes
-
-
-# 集群模式的控制节点
-def master():
-    cfg.log.info('===Shrink Master Node is starting to dispatch task to worker node===')
-    user_data = '#!/bin/bash\ncd /home/ec2-user/ShrinkEbs\npython3 shrink.py -o a -o s'
-
-    user_data += ' -o b' if 'b' in cfg.args.omit else ''
-    self = ec2.Instance(cfg.instance['instanceId'])
-    images = [image for image in ec2.images.filter(Filters=[dict(Name='name', Values=['VolumeShrink'])])]
-    if images:
-        image = images[0]
-        cfg.log.info('%s found for worker nodes' % image.id)
+        pending.append(dict(origin=restore_volume(snapshot)))
+        if len(pending) > cfg.LookAhead:
+            yield pending.popleft()
+    while pending:
+        yield pending.popleft()
+
+
+# 快照恢复为盘，不等待可用
+def restore_volume(snapshot):
+    volume = ec2.create_volume(SnapshotId=snapshot.id, VolumeType='gp2',
+                               AvailabilityZone=cfg.instance['availabilityZone'],
+                               TagSpecifications=[dict(ResourceType='volume', Tags=[
+                                   dict(Key='Origin', Value=snapshot.id), dict(Key='Project', Value='ShrinkVolume')])])
+    cfg.log.info('%s restoring from %s' % (volume.id, snapshot.id))
+    return volume
 
-    else:
-        image = self.create_image(Description='VolumeShrink tools', Name='VolumeShrink', NoReboot=True)
-        cfg.log.info('Creating %s for worker nodes' % image.id)
 
-    image.wait_until_exists()
-    for i in range(cfg.TIMEOUT):
-        image.load()
-        if image.state == 'available':
-            break
-        time.sleep(3)
-    else:
-        cfg.log.error('%s(old) failed to remove, exiting' % image.id)
-        return
-
-    idx = 0
-    for instance in get_instances(same_az=False):
-        idx += 1
-        worker = ec2.create_instances(InstanceType='c5.large', MaxCount=1, MinCount=1, EbsOptimized=True,
-                                      ImageId=image.id,
-                                      IamInstanceProfile=dict(Arn=self.iam_instance_profile['Arn']),
-                                      Placement={'AvailabilityZone': instance.placement['AvailabilityZone']},
-                                      UserData='%s instance-id=%s\nsudo shutdown\n' % (user_data, instance.id),
-                                      InstanceInitiatedShutdownBehavior='terminate',
-                                      )[0]
-        worker.create_tags(Tags=[dict(Key='Name', Value='ShrinkWorker'),
-                                 dict(Key='Project', Value='ShrinkVolume'),
-                                 dict(Key='ShrinkingFor', Value=instance.id),
-                                 ])
-        instance.create_tags(Tags=[dict(Key='ShrinkingBy', Value=worker.id)])
-        cfg.log.info('%s(worker) is starting to shrink volumes of %s(target)' % (worker.id, instance.id))
-
-    # clear_image(image)
-    cfg.log.info('===%s ShrinkWorker is starting... Master Node terminated normally===' % idx)
-
-
-def clear_image(image):
-    snapshots = [ec2.Snapshot(device['Ebs']['SnapshotId']) for device in image.block_device_mappings]
-    image.deregister()
-    [snapshot.delete() for snapshot in snapshots]
-    cfg.log.info('%s and %s deleted.' % (image.id, [s.id for s in snapshots]))
+# 等待快照恢复的盘可用
+@timeline.span('restore')
+def wait_restored(volume, key='origin'):
+    """
+    :param key: 恢复的盘在volume中的键，快照/AMI缩容为origin，两阶段缩容的临时盘为seed
+    """
+    if not waiter.wait_volume(volume[key], waiter.volume_state('available'), cfg.RestoreTimeout):
+        raise UserWarning('restore %s Time out' % volume[key].id)
 
 
 if __name__ == '__main__':
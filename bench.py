@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @File  : bench.py
+# @Author: Bai Yanzheng
+# @Date  : 2026/10/18
+# @Desc  : 离线基准测试：用moto模拟EC2，用loop设备模拟EBS盘，完整运行shrink.py的EC2缩容流程
+# 每个场景建一台目标实例和若干源盘，源盘内容为合成的目录树：大量小文件、少量大文件、稀疏文件、无法mount的分区。
+# 输出每个场景的盘数/小时、MB/s和模拟停机时长，可与以前的结果(--baseline)对比。
+# 需要root权限、moto、losetup、sfdisk、mkfs.ext4、rsync
+# 用法：sudo python3 bench.py [-s 场景] [--scale 0.5] [--json result.json] [--baseline old.json]
+#
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import time
+
+import aws
+import config as cfg
+import linux
+import shrink
+import timeline
+
+VolumeSize = 8  # 源盘大小(GB)，图像文件是稀疏文件，不实际占用
+Scenarios = ['small_files', 'huge_files', 'sparse_files', 'unmountable']
+images = {}  # {volume_id: 图像文件}
+
+
+def args_parser():
+    parser = argparse.ArgumentParser(description='Offline benchmark of shrink.py with moto and loop devices.')
+    parser.add_argument('-s', '--scenario', action='append', choices=Scenarios, help='scenarios, default all')
+    parser.add_argument('-n', '--volumes', type=int, default=2, help='source volumes per scenario')
+    parser.add_argument('--scale', type=float, default=1.0, help='scale of synthetic data')
+    parser.add_argument('--root', default='/var/tmp/shrink-bench', help='directory for volume images')
+    parser.add_argument('--json', help='save results to this file')
+    parser.add_argument('--baseline', help='compare with results saved by --json')
+    return parser.parse_args()
+
+
+# 盘对应的稀疏图像文件，第一次用到时按盘大小创建
+def image(volume, root):
+    if volume.id not in images:
+        images[volume.id] = os.path.join(root, '%s.img' % volume.id)
+        with open(images[volume.id], 'wb') as fp:
+            fp.truncate(volume.size * 1024 ** 3)
+    return images[volume.id]
+
+
+def losetup(path):
+    return linux.run(['losetup', '-P', '--find', '--show', path]).stdout.strip()
+
+
+# 挂到本机的盘映射到loop设备，设备释放时拆掉loop
+def patch(root):
+    attach_volume, free_device = aws.attach_volume, linux.free_device
+
+    def attach(volume, device, instance_id):
+        attach_volume(volume, device, instance_id)
+        if instance_id == cfg.instance['instanceId']:
+            linux.aliases[device] = losetup(image(volume, root))
+
+    def free(device):
+        loop = linux.aliases.pop(device, None)
+        linux.run(['losetup', '-d', loop]) if loop else None
+        free_device(device)
+
+    aws.attach_volume, linux.free_device = attach, free
+
+
+# 生成场景数据，返回写入的字节数
+def fill(scenario, mount_point, scale):
+    written = 0
+    if scenario == 'small_files':
+        for i in range(int(20000 * scale)):
+            path = os.path.join(mount_point, 'd%03d' % (i % 200), 'f%06d' % i)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            data = os.urandom(1024 + i % 7168)
+            with open(path, 'wb') as fp:
+                fp.write(data)
+            written += len(data)
+            if i % 10 == 0:  # 夹带硬链接
+                os.link(path, path + '.link')
+    elif scenario == 'huge_files':
+        chunk = os.urandom(4 * 1048576)
+        for i in range(3):
+            with open(os.path.join(mount_point, 'huge%d' % i), 'wb') as fp:
+                for _ in range(int(128 * scale)):
+                    fp.write(chunk)
+                    written += len(chunk)
+    elif scenario == 'sparse_files':
+        chunk = os.urandom(1048576)
+        for i in range(int(20 * scale)):
+            with open(os.path.join(mount_point, 'sparse%02d' % i), 'wb') as fp:
+                for offset in range(0, 256, 64):  # 256MB文件中只有4MB数据
+                    fp.seek(offset * 1048576)
+                    fp.write(chunk)
+                    written += len(chunk)
+                fp.truncate(256 * 1048576)
+    return written
+
+
+# 建一块源盘：moto中建盘挂到目标实例，对应的图像文件分区、建文件系统、填数据
+def build(scenario, target, device, root, scale):
+    volume = aws.ec2.create_volume(Size=VolumeSize, VolumeType='gp2',
+                                   AvailabilityZone=cfg.instance['availabilityZone'])
+    volume.attach_to_instance(Device=device, InstanceId=target.id)
+    loop = losetup(image(volume, root))
+    try:
+        if scenario == 'unmountable':  # 1GB无文件系统的分区，开头写些数据；其后是几乎空的ext4分区，整盘用量低才会缩容
+            linux.run(['sfdisk', loop], stdin='label: gpt\n,1GiB,L\n,,L\n')
+            linux.run(['udevadm', 'settle'])
+            size = int(256 * scale) * 1048576
+            with open(linux.partition_device(loop, 1), 'r+b') as fp:
+                fp.write(os.urandom(size))
+            linux.run(['mkfs.ext4', '-q', linux.partition_device(loop, 2)])
+            return size
+        linux.run(['sfdisk', loop], stdin='label: gpt\n,,L\n')
+        linux.run(['udevadm', 'settle'])
+        partition = linux.partition_device(loop, 1)
+        linux.run(['mkfs.ext4', '-q', partition])
+        mount_point = os.path.join(root, 'fill')
+        os.makedirs(mount_point, exist_ok=True)
+        linux.run(['mount', partition, mount_point])
+        try:
+            return fill(scenario, mount_point, scale)
+        finally:
+            linux.run(['umount', mount_point])
+    finally:
+        linux.run(['losetup', '-d', loop])
+
+
+# 跑一个场景
+def run(scenario, count, root, scale):
+    target = aws.ec2.create_instances(ImageId='ami-12c6146b', InstanceType='t3.micro', MinCount=1, MaxCount=1,
+                                      Placement={'AvailabilityZone': cfg.instance['availabilityZone']},
+                                      TagSpecifications=[dict(ResourceType='instance', Tags=[
+                                          dict(Key='Bench', Value=scenario)])])[0]
+    written = sum(build(scenario, target, '/dev/sd%s' % chr(ord('f') + i), root, scale) for i in range(count))
+    cfg.args.filters = [dict(Name='tag:Bench', Values=[scenario])]
+    del timeline.events[:]
+    shrink.reducedGB = 0
+
+    start = time.time()
+    shrink.shrink_ec2s()
+    seconds = time.time() - start
+
+    summary = timeline.summary()
+    copy_seconds = summary.get('copy', {}).get('total', 0)
+    return dict(volumes=count, seconds=round(seconds, 1), written_mb=round(written / 1048576, 1),
+                volumes_per_hour=round(count * 3600 / seconds, 1),
+                mbps=round(written / 1048576 / seconds, 1),
+                copy_mbps=round(written / 1048576 / copy_seconds, 1) if copy_seconds else 0,
+                downtime=round(summary.get('downtime', {}).get('max', 0), 1),
+                reduced_gb=shrink.reducedGB)
+
+
+# 与基准结果对比，数值变化以百分比表示
+def compare(results, baseline):
+    for scenario, result in results.items():
+        old = baseline.get(scenario)
+        if not old:
+            continue
+        changes = ['%s %+.0f%%' % (key, (result[key] - old[key]) * 100 / old[key])
+                   for key in ('volumes_per_hour', 'mbps', 'copy_mbps', 'downtime') if old.get(key)]
+        print('%-14s vs baseline: %s' % (scenario, ', '.join(changes)))
+
+
+def main():
+    args = args_parser()
+    if os.geteuid() != 0:
+        sys.exit('bench.py needs root for loop devices and mounts')
+    try:
+        from moto import mock_aws
+    except ImportError:
+        from moto import mock_ec2 as mock_aws
+    for key in ('AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY'):
+        os.environ.setdefault(key, 'testing')
+    os.environ['AWS_DEFAULT_REGION'] = 'us-east-1'
+
+    shutil.rmtree(args.root, ignore_errors=True)
+    os.makedirs(args.root)
+    cfg.WorkPath = os.path.join(args.root, 'work')
+    os.makedirs(cfg.WorkPath)
+    cfg.log = logging.getLogger()
+    cfg.log.setLevel(logging.INFO)
+    handler = logging.FileHandler(os.path.join(args.root, 'bench.log'))
+    handler.setFormatter(logging.Formatter('%(asctime)s\t%(levelname)s\t%(filename)s %(lineno)d\t%(message)s'))
+    cfg.log.addHandler(handler)
+    cfg.args = argparse.Namespace(filters=[], omit={'a', 's', 'b'}, interactive=False, incremental=False, block=False, hydrate=False, boost=False,
+                                  master=False, worker=False)
+
+    results = {}
+    with mock_aws():
+        aws.setup()
+        worker = aws.ec2.create_instances(ImageId='ami-12c6146b', InstanceType='c5.large', MinCount=1, MaxCount=1,
+                                          Placement={'AvailabilityZone': 'us-east-1a'})[0]
+        cfg.instance = dict(instanceId=worker.id, instanceType='c5.large', availabilityZone='us-east-1a',
+                            region='us-east-1')
+        shrink.setup()
+        patch(args.root)
+        for scenario in args.scenario or Scenarios:
+            results[scenario] = run(scenario, args.volumes, args.root, args.scale)
+            print('%-14s %s' % (scenario, json.dumps(results[scenario])))
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as fp:
+            json.dump(results, fp, indent=2)
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as fp:
+            compare(results, json.load(fp))
+
+
+if __name__ == '__main__':
+    main()
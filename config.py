@@ -10,14 +10,41 @@ import json
 import logging
 import os
 import sys
-from linux import cmd
+from linux import run
 
 # 常量参数定义
 WorkPath = '/tmp/shrink'
-RepCapacity = 6  # 并发处理此数量的磁盘缩容
+RepCapacity = 0  # 同时缩容的磁盘数上限，0为按本机可挂载的磁盘数自动确定
 MinVolumeSize = 5  # 小于此容量(GB)的盘不缩容
 ExpandFactor = 1.2  # 缩容到实战容量的比例
 TIMEOUT = 30  # AWS服务超时次数/秒数
+InstanceTimeout = 600  # 等待实例启停的秒数
+SnapshotTimeout = 6 * 3600  # 等待快照完成的秒数
+PollInterval = 1  # 集中轮询AWS资源状态的间隔秒数
+CopyWorkers = 4  # 每个分区并行复制的rsync进程数
+CopyShardDepth = 2  # 复制时按此层数切分源目录树
+RawBlockSize = 4 * 1048576  # 按块复制时每次读写的字节数
+HydrateWorkers = 16  # 快照恢复的源盘并行预读线程数，本机各盘共用，每线程一块HydrateBlockSize的缓冲
+HydrateBlockSize = 8 * 1048576  # 预读每次读取的字节数
+LookAhead = 2  # 快照缩容时在空闲槽位之外提前恢复的盘数
+RestoreTimeout = 1800  # 等待快照恢复的盘可用的秒数
+BoostIops = 16000  # 复制期间新盘临时提到的gp3 IOPS，受容量限制
+BoostThroughput = 1000  # 复制期间新盘临时提到的gp3吞吐(MB/s)，受IOPS限制
+WorkersPerAZ = 10  # 集群模式每个AZ最多启动的工作节点数
+WorkerBudget = 4 * 3600  # 集群模式每个工作节点计划处理的秒数，决定工作节点数
+CopyMBps = 100  # 估算复制时间用的吞吐(MB/s)
+InstanceOverhead = 600  # 估算每台实例停机、挂盘、启动等固定开销的秒数
+WorkerIdle = 1800  # 常驻工作节点空闲此秒数后关机
+WorkerPoll = 10  # 常驻工作节点查询新任务的间隔秒数
+MkfsProfile = 'fast'  # 新盘建文件系统的方式，见MkfsProfiles
+MkfsProfiles = dict(default=[], fast=['-E', 'lazy_itable_init=1,lazy_journal_init=1,nodiscard'])  # inode表和日志挂载后后台初始化，新盘不做discard
+XfsProfiles = dict(default=[], fast=['-K'])  # mkfs.xfs，新盘不做discard
+XfsMinSize = 300  # mkfs.xfs支持的最小分区(MB)
+DeviceTimeout = 60  # 挂盘、分区后等待本机块设备出现的秒数
+CommandTimeout = 300  # mount/blkid/fdisk等短命令的超时秒数
+ApiRates = dict(describe=(100, 20), mutate=(50, 5), tags=(100, 10))  # 各类EC2 API的令牌桶(容量, 每秒补充数)
+ApiAttempts = 10  # EC2 API调用最多尝试次数，adaptive重试模式
+StatsdAddress = ('127.0.0.1', 8125)  # CloudWatch Agent的statsd地址，接收各阶段耗时汇总
 YES = ['', 'y', 'Y']
 
 # 全局变量定义
@@ -47,6 +74,7 @@ volumeRepository = []  # 处理中的磁盘仓库
 dict(origin=volume,
      dup=None,
      partitions = [dict(dev=, uuid=, label=, size=, dupdev=)],
+     devices=dict(source='/dev/sdf', dup='/dev/sdg'),  # 本机上源盘/新盘的设备名，挂载点由此而来
      task=None,
      instance=instance, 
      dev='dev/sdf', 
@@ -58,12 +86,9 @@ dict(origin=volume,
 def setup(args_=None):
     global log, args, instance
 
-    # 创建/tmp/shrink/f...目录，用于挂载磁盘
+    # 创建/tmp/shrink目录，磁盘挂载点在挂载时按设备名创建
     None if os.path.exists(WorkPath) else os.mkdir(WorkPath)
-    None if os.path.exists(os.path.join(WorkPath, 'boot')) else cmd('sudo cp -r /boot /tmp/shrink/boot')
-    for f in range(102, 102 + RepCapacity * 2):
-        if not os.path.exists(os.path.join(WorkPath, chr(f))):
-            os.mkdir(os.path.join(WorkPath, chr(f)))
+    None if os.path.exists(os.path.join(WorkPath, 'boot')) else run(['cp', '-r', '/boot', os.path.join(WorkPath, 'boot')])
 
     # 初始化日志
     log = logging.getLogger()
@@ -78,7 +103,7 @@ def setup(args_=None):
     args = args_
 
     # 获取本机参数
-    instance = json.loads(cmd('curl -s 169.254.169.254/latest/dynamic/instance-identity/document'))
+    instance = json.loads(run(['curl', '-s', '169.254.169.254/latest/dynamic/instance-identity/document'], sudo=False).stdout)
     os.environ['AWS_DEFAULT_REGION'] = instance['region']  # 设置工作region
 
 
@@ -0,0 +1,331 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @File  : copier.py
+# @Author: Bai Yanzheng
+# @Date  : 2026/10/18
+# @Desc  : 分区数据复制引擎
+# rsync: 把源目录树按层切成分片，多个rsync进程并行复制，最后整树rsync一遍补齐：
+#        跨分片的硬链接、目录属性、分片遗漏的文件都在最后一遍处理
+# raw:   无法mount的分区按块复制，能识别文件系统的只复制已分配块，否则跳过全零块稀疏写入
+# block: 可丢弃的ext源分区先resize2fs -M缩到最小，只顺序复制已用的前段，再在新分区上扩满
+# hydrate: 快照恢复的源盘首次读取要从S3加载，后台多线程大块预读，ext只读已用块
+# xfs:   XFS分区用xfsdump | xfsrestore整树复制，按inode顺序读写，保留扩展属性和ACL
+#
+
+import os
+import re
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import config as cfg
+import linux
+
+RsyncOptions = ['-a', '-r', '-H', '-A', '-X', '-S', '--numeric-ids', '--stats']  # 保留硬链接、ACL、扩展属性、稀疏文件
+Stats = dict(files=re.compile(r'Number of regular files transferred: ([\d,]+)'),
+             bytes=re.compile(r'Total transferred file size: ([\d,]+)'))
+Ext = ('ext2', 'ext3', 'ext4')
+hydrators = None  # 本机各盘共用的预读线程池，第一次预读时创建
+hydrators_lock = threading.Lock()
+buffers = threading.local()  # 预读线程各自的读缓冲，反复使用
+RsyncVanished = 24  # 复制过程中源文件消失，两阶段缩容的增量同步会再补齐
+
+
+# 解析rsync --stats输出
+def parse_stats(stdout):
+    stats = dict(files=0, bytes=0)
+    for key, pattern in Stats.items():
+        match = pattern.search(stdout)
+        if match:
+            stats[key] = int(match.group(1).replace(',', ''))
+    return stats
+
+
+# 列出分片：源根目录下cfg.CopyShardDepth层内的文件，以及最深一层的目录
+def shards(source, depth):
+    """
+    :param source: 源分区挂载点
+    :param depth: 切分层数
+    :return: [(size, 相对路径)]，按大小降序
+    """
+    units = []
+    output = linux.run(['find', source, '-mindepth', 1, '-maxdepth', depth, '-printf', '%y %s %d %P\\0'], echo=False).stdout
+    for entry in output.split('\0'):
+        fields = entry.split(' ', 3)
+        if len(fields) < 4:
+            continue
+        kind, size, level, path = fields
+        if kind == 'd' and int(level) < depth:  # 中间层目录由下层分片带出
+            continue
+        units.append((int(size), path))
+    return sorted(units, reverse=True)
+
+
+# 执行rsync，空间不足、部分文件未复制等失败时抛出异常，以免不完整的新盘替换原盘
+def run_rsync(argv):
+    result = linux.run(['rsync'] + argv)
+    if result.code not in (0, RsyncVanished):
+        raise UserWarning('rsync %s failed with exit code %d' % (' '.join(argv[-2:]), result.code))
+    return parse_stats(result.stdout)
+
+
+# 单个rsync进程复制一组分片
+def rsync_files(source, dst, paths):
+    with tempfile.NamedTemporaryFile('w', dir=cfg.WorkPath, prefix='files-', delete=False) as fp:
+        fp.write('\n'.join(paths) + '\n')
+    try:
+        return run_rsync(RsyncOptions + ['--files-from=%s' % fp.name, source + '/', dst + '/'])
+    finally:
+        os.remove(fp.name)
+
+
+# 并行复制一个分区
+def rsync(source, dst, delta=False, workers=None):
+    """
+    :param source: 源分区挂载点
+    :param dst: 目标分区挂载点
+    :param delta: 目标已有数据，同步时删除源上已不存在的文件
+    :param workers: 并行rsync进程数，默认cfg.CopyWorkers
+    :return: dict(files=, bytes=, seconds=)
+    """
+    workers = workers or cfg.CopyWorkers
+    start = time.time()
+    total = dict(files=0, bytes=0)
+    units = shards(source, cfg.CopyShardDepth) if workers > 1 else []
+    if units:
+        # 大文件/目录轮流分到各组，每组一个rsync进程，组数多于进程数以便先完成的进程领取下一组
+        groups = [[] for _ in range(min(len(units), workers * 4))]
+        for i, (size, path) in enumerate(units):
+            groups[i % len(groups)].append(path)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for stats in executor.map(lambda paths: rsync_files(source, dst, paths), groups):
+                total = {k: total[k] + stats[k] for k in total}
+    stats = run_rsync(RsyncOptions + (['--delete'] if delta else []) + [source + '/', dst + '/'])
+    total = {k: total[k] + stats[k] for k in total}
+    total['seconds'] = max(time.time() - start, 0.001)
+    cfg.log.info('rsync %s -> %s: %d files, %dMB in %ds by %d workers, %.1f files/s, %.1fMB/s' %
+                 (source, dst, total['files'], total['bytes'] / 1048576, total['seconds'], workers,
+                  total['files'] / total['seconds'], total['bytes'] / 1048576 / total['seconds']))
+    return total
+
+
+# XFS分区全量复制，源和目标都须已mount；本机未装xfsdump时改用rsync
+def xfs(source, dst):
+    """
+    :param source: 源分区挂载点
+    :param dst: 目标分区挂载点，新建的空XFS
+    """
+    start = time.time()
+    try:
+        result = linux.pipe(['xfsdump', '-J', '-l', '0', '-v', 'silent', '-L', 'shrink', '-', source],
+                            ['xfsrestore', '-J', '-v', 'silent', '-', dst])
+    except OSError as err:
+        cfg.log.warning('xfsdump unavailable(%s), copying %s by rsync' % (err, source))
+        rsync(source, dst)
+        return
+    if result.code:
+        raise UserWarning('xfsdump | xfsrestore %s -> %s failed' % (source, dst))
+    stat = os.statvfs(dst)
+    used, seconds = (stat.f_blocks - stat.f_bfree) * stat.f_frsize, max(time.time() - start, 0.001)
+    cfg.log.info('xfsdump %s -> %s: %dMB in %ds, %.1fMB/s' %
+                 (source, dst, used / 1048576, seconds, used / 1048576 / seconds))
+
+
+# 按块复制无法mount的分区
+def raw(partition, delta=False):
+    """
+    :param partition: dict(dev=, dupdev=, type=, uuid=, label=)
+    :param delta: 目标已有旧数据，全零块也要写入
+    """
+    source, dst, fstype = partition['dev'], partition['dupdev'], partition.get('type', '')
+    start = time.time()
+    if fstype in Ext or fstype == 'ntfs':  # 只复制已分配块，本机未装ntfsclone等工具时按块全量复制
+        argv = ['e2image', '-ra', '-p', source, dst] if fstype in Ext else ['ntfsclone', '--overwrite', dst, source]
+        try:
+            code = linux.run(argv).code
+        except OSError as err:
+            cfg.log.warning('%s unavailable: %s' % (argv[0], err))
+            code = -1
+    elif fstype == 'swap':  # 交换分区无需数据，重建即可
+        label = partition.get('label', '')
+        if linux.run(['mkswap', '-U', partition['uuid']] + (['-L', label] if label else []) + [dst]).code:
+            raise UserWarning('mkswap %s failed' % dst)
+        code = 0
+    else:
+        whole(source, dst, delta)
+        return
+    if code:  # 无法mount的分区文件系统多半已损坏，按文件系统复制失败时逐块全量复制，覆盖已写入的部分
+        cfg.log.warning('raw copy(%s) %s -> %s failed, copying all blocks' % (fstype, source, dst))
+        whole(source, dst, True)
+        return
+    cfg.log.info('raw copy(%s) %s -> %s in %ds' % (fstype or 'unknown', source, dst, time.time() - start))
+
+
+# 逐块复制整个分区
+def whole(source, dst, delta=False):
+    if os.access(source, os.R_OK) and os.access(dst, os.W_OK):
+        sparse_copy(source, dst, delta)
+        return
+    argv = ['dd', 'if=%s' % source, 'of=%s' % dst, 'bs=%d' % cfg.RawBlockSize] + ([] if delta else ['conv=sparse'])
+    if linux.run(argv).code:
+        raise UserWarning('dd %s -> %s failed' % (source, dst))
+
+
+# 按块缩容ext分区，源分区会被缩小，只用于快照恢复的临时盘等可丢弃的源
+def block(partition):
+    """
+    :param partition: dict(dev=, dupdev=)，源分区不能mount，新分区尚无文件系统
+    :return: 成功返回True，新分区容不下缩小后的文件系统时返回False，由调用方改用rsync
+    """
+    source, dst = partition['dev'], partition['dupdev']
+    start = time.time()
+    if linux.run(['e2fsck', '-f', '-y', source], echo=False).code > 1:  # resize2fs要求先检查
+        raise UserWarning('e2fsck %s failed' % source)
+    if linux.run(['resize2fs', '-M', source]).code:
+        raise UserWarning('resize2fs -M %s failed' % source)
+    header = linux.run(['dumpe2fs', '-h', source], echo=False).stdout
+    fields = dict(line.split(':', 1) for line in header.splitlines() if ':' in line)
+    used = int(fields['Block count']) * int(fields['Block size'])
+    room = int(linux.run(['blockdev', '--getsize64', dst]).stdout)
+    if used > room:
+        cfg.log.warning('%s needs %dMB at least, more than %dMB of %s' % (source, used / 1048576, room / 1048576, dst))
+        return False
+    if linux.run(['dd', 'if=%s' % source, 'of=%s' % dst, 'bs=%d' % cfg.RawBlockSize, 'count=%d' % used,
+                  'iflag=count_bytes', 'conv=sparse']).code:  # 复制不全时resize2fs仍可能成功，不能以此判断
+        raise UserWarning('dd %s -> %s failed' % (source, dst))
+    if linux.run(['resize2fs', dst]).code:  # 扩满新分区
+        raise UserWarning('resize2fs %s failed' % dst)
+    seconds = max(time.time() - start, 0.001)
+    cfg.log.info('block copy %s -> %s: %dMB in %ds, %.1fMB/s' %
+                 (source, dst, used / 1048576, seconds, used / 1048576 / seconds))
+    return True
+
+
+# ext分区已用块的字节区间，间隔小于cfg.HydrateBlockSize的合并，非ext返回整个分区
+def extents(device):
+    """
+    :return: [(offset, length)]
+    """
+    result = linux.run(['dumpe2fs', device], echo=False)
+    if result.code:
+        return [(0, int(linux.run(['blockdev', '--getsize64', device]).stdout))]
+    block_size, used, group, cursor = 0, [], None, 0
+    for line in result.stdout.splitlines():
+        line = line.strip()
+        if line.startswith('Block size:'):
+            block_size = int(line.split(':')[1])
+        elif line.startswith('Group '):  # Group 0: (Blocks 0-32767) ...
+            match = re.search(r'\(Blocks (\d+)-(\d+)\)', line)
+            group = (int(match.group(1)), int(match.group(2))) if match else None
+            cursor = group[0] if group else 0
+        elif line.startswith('Free blocks:') and group:  # Free blocks: 1234-5678, 6000
+            for item in line.split(':', 1)[1].split(','):
+                if not item.strip():
+                    continue
+                first, _, last = item.strip().partition('-')
+                used.append((cursor, int(first))) if int(first) > cursor else None
+                cursor = int(last or first) + 1
+            used.append((cursor, group[1] + 1)) if cursor <= group[1] else None
+            group = None
+    merged = []
+    for first, end in used:
+        if merged and (first - merged[-1][1]) * block_size < cfg.HydrateBlockSize:
+            merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((first, end))
+    return [(first * block_size, (end - first) * block_size) for first, end in merged]
+
+
+def hydrate_pool():
+    global hydrators
+    with hydrators_lock:
+        if hydrators is None:
+            hydrators = ThreadPoolExecutor(max_workers=cfg.HydrateWorkers, thread_name_prefix='hydrate')
+        return hydrators
+
+
+# 大块读取源分区，数据丢弃，只为让EBS从快照加载；stop置位时尽快结束
+# 各盘共用cfg.HydrateWorkers个线程，每盘最多cfg.HydrateWorkers个读请求在排队或进行，内存只占各线程的缓冲
+def hydrate(partitions, stop):
+    """
+    :param partitions: [dict(dev=)]
+    :param stop: threading.Event
+    """
+    start, counted, errors = time.time(), [0], []
+    lock, window = threading.Lock(), threading.BoundedSemaphore(cfg.HydrateWorkers)
+
+    def read(fd, offset, length):
+        try:
+            if stop.is_set() or errors:
+                return
+            if getattr(buffers, 'buffer', None) is None:
+                buffers.buffer = bytearray(cfg.HydrateBlockSize)
+            n = os.preadv(fd, [memoryview(buffers.buffer)[:length]], offset)
+            with lock:
+                counted[0] += n
+        except OSError as err:
+            errors.append(err)
+        finally:
+            window.release()
+
+    pool = hydrate_pool()
+    for partition in partitions:
+        device = partition['dev']
+        if stop.is_set() or errors or not os.access(device, os.R_OK):
+            continue
+        fd = os.open(device, os.O_RDONLY)
+        try:
+            for first, length in extents(device):
+                for offset in range(first, first + length, cfg.HydrateBlockSize):
+                    if stop.is_set() or errors:
+                        break
+                    window.acquire()
+                    try:
+                        pool.submit(read, fd, offset, min(cfg.HydrateBlockSize, first + length - offset))
+                    except RuntimeError:  # 线程池已关闭，进程正在退出
+                        window.release()
+                        raise
+        finally:
+            for _ in range(cfg.HydrateWorkers):  # 等本分区的读请求都结束再关闭
+                window.acquire()
+            for _ in range(cfg.HydrateWorkers):
+                window.release()
+            os.close(fd)
+    if errors:
+        raise errors[0]
+    total, seconds = counted[0], max(time.time() - start, 0.001)
+    cfg.log.info('hydrate %s: %dMB read in %ds by %d threads, %.1fMB/s%s' %
+                 (','.join(p['dev'] for p in partitions), total / 1048576, seconds, cfg.HydrateWorkers,
+                  total / 1048576 / seconds, ', stopped' if stop.is_set() else ''))
+
+
+# 大块顺序读，全零块不写，新EBS盘未写过的块读出即为零
+def sparse_copy(source, dst, delta=False):
+    start, copied, skipped = time.time(), 0, 0
+    buffer, zero = bytearray(cfg.RawBlockSize), bytes(cfg.RawBlockSize)
+    view = memoryview(buffer)
+    src, out = os.open(source, os.O_RDONLY), os.open(dst, os.O_WRONLY)
+    try:
+        offset = 0
+        while True:
+            n = os.readv(src, [buffer])
+            if not n:
+                break
+            if not delta and view[:n] == zero[:n]:
+                skipped += n
+            else:
+                os.pwrite(out, view[:n], offset)
+                copied += n
+            offset += n
+        os.fsync(out)
+    finally:
+        os.close(src)
+        os.close(out)
+    seconds = max(time.time() - start, 0.001)
+    cfg.log.info('raw copy %s -> %s: %dMB written, %dMB zero skipped in %ds, %.1fMB/s' %
+                 (source, dst, copied / 1048576, skipped / 1048576, seconds, (copied + skipped) / 1048576 / seconds))
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @File  : fleet.py
+# @Author: Bai Yanzheng
+# @Date  : 2026/10/18
+# @Desc  : 集群模式的控制节点
+# 按AZ汇总待缩容磁盘容量，估算每台目标实例的处理时间，
+# 每个AZ使用有限数量的工作节点，按处理时间把目标实例装箱分给各工作节点。
+# 工作节点常驻，通过目标实例的ShrinkingBy标签领取任务，空闲一段时间后标记ShrinkDraining并自行关机，
+# 控制节点不再向其分派；
+# 工作节点AMI按本工具源码的哈希区分版本，代码不变时直接复用
+#
+
+import hashlib
+import json
+import math
+import os
+
+import aws
+import config as cfg
+
+WorkerType = 'c5.large'
+PlanFile = 'fleet.json'  # 分配计划，写在cfg.WorkPath下
+DrainingTag = 'ShrinkDraining'  # 工作节点即将关机
+
+
+# 估算一台目标实例的处理时间(秒)：启停、挂盘等固定开销加上按容量的复制时间
+def expected_seconds(volumes):
+    return cfg.InstanceOverhead + sum(v['origin'].size * 1024 / cfg.CopyMBps for v in volumes)
+
+
+# 制定分配计划
+def plan():
+    """
+    :return: {az: [dict(seconds=, targets=[instance])]}，每个元素是一个工作节点及其目标队列
+    """
+    targets, instances = {}, list(aws.get_instances(same_az=False))
+    live = live_workers(instances)
+    for instance in instances:
+        tags = {tag['Key']: tag['Value'] for tag in instance.tags or []}
+        if tags.get('ShrinkingBy', '') in live:  # 正由工作节点处理
+            cfg.log.info('%s skipped, being shrunk by %s' % (instance.id, tags['ShrinkingBy']))
+            continue
+        if 'ShrinkedBy' in tags:  # 已缩容过，删除该标签可再次缩容
+            cfg.log.info('%s skipped, already shrunk by %s' % (instance.id, tags['ShrinkedBy']))
+            continue
+        volumes = aws.get_instance_volumes(instance)
+        if not volumes:
+            continue
+        az = instance.placement['AvailabilityZone']
+        size = sum(v['origin'].size for v in volumes)
+        targets.setdefault(az, []).append((expected_seconds(volumes), size, instance))
+
+    plans = {}
+    for az, items in targets.items():
+        total = sum(seconds for seconds, _, _ in items)
+        count = min(cfg.WorkersPerAZ, len(items), max(1, math.ceil(total / cfg.WorkerBudget)))
+        workers = [dict(seconds=0, targets=[]) for _ in range(count)]
+        for seconds, _, instance in sorted(items, key=lambda item: item[0], reverse=True):  # 耗时长的先分，分给最空闲的节点
+            worker = min(workers, key=lambda w: w['seconds'])
+            worker['seconds'] += seconds
+            worker['targets'].append(instance)
+        plans[az] = workers
+        cfg.log.info('%s: %d targets, %dGB, about %ds, %d workers' %
+                     (az, len(items), sum(size for _, size, _ in items), total, count))
+    return plans
+
+
+# 目标实例上ShrinkingBy标签中仍在运行的工作节点，已终止的节点领取的任务重新分派
+def live_workers(instances):
+    ids = {tag['Value'] for instance in instances for tag in instance.tags or [] if tag['Key'] == 'ShrinkingBy'}
+    if not ids:
+        return set()
+    return {worker.id for worker in aws.ec2.instances.filter(Filters=[
+        dict(Name='instance-id', Values=sorted(ids)),
+        dict(Name='instance-state-name', Values=['pending', 'running'])])}
+
+
+# 保存分配计划，便于查看进度和复盘
+def save(plans, workers):
+    records = [dict(az=az, worker=worker_id, seconds=int(worker['seconds']), targets=[i.id for i in worker['targets']])
+               for az, items in plans.items() for worker, worker_id in zip(items, workers[az])]
+    with open(os.path.join(cfg.WorkPath, PlanFile), 'w', encoding='utf-8') as fp:
+        json.dump(records, fp, indent=2)
+
+
+# 本工具源码的哈希，作为工作节点AMI的版本
+def version():
+    digest = hashlib.sha256()
+    root = os.path.dirname(os.path.abspath(__file__))
+    for name in sorted(os.listdir(root)):
+        if name.endswith('.py') or name == 'grub.cfg':
+            digest.update(name.encode('utf-8'))
+            with open(os.path.join(root, name), 'rb') as fp:
+                digest.update(fp.read())
+    return digest.hexdigest()[:12]
+
+
+# 当前版本的工作节点AMI，没有就用本机制作
+def worker_image(version_):
+    self = aws.ec2.Instance(cfg.instance['instanceId'])
+    name = 'VolumeShrink-%s' % version_
+    images = [image for image in aws.ec2.images.filter(Filters=[dict(Name='name', Values=[name])])]
+    if images:
+        image = images[0]
+        cfg.log.info('%s(%s) found for worker nodes' % (image.id, name))
+
+    else:
+        image = self.create_image(Description='VolumeShrink tools %s' % version_, Name=name, NoReboot=True)
+        image.wait_until_exists()
+        image.create_tags(Tags=[dict(Key='Project', Value='ShrinkVolume'), dict(Key='Version', Value=version_)])
+        cfg.log.info('Creating %s(%s) for worker nodes' % (image.id, name))
+
+    try:  # 制作AMI要给本机系统盘做快照，按快照的超时等待
+        aws.client_ec2.get_waiter('image_available').wait(
+            ImageIds=[image.id], WaiterConfig=dict(Delay=15, MaxAttempts=int(cfg.SnapshotTimeout / 15)))
+    except Exception as err:
+        cfg.log.error('%s is not available, exiting. %s' % (image.id, err))
+        return None
+    return image
+
+
+# 指定AZ内当前版本、仍在运行且未准备关机的工作节点
+def warm_workers(az, version_):
+    return [worker for worker in aws.ec2.instances.filter(Filters=[
+        dict(Name='tag:Name', Values=['ShrinkWorker']),
+        dict(Name='tag:Version', Values=[version_]),
+        dict(Name='availability-zone', Values=[az]),
+        dict(Name='instance-state-name', Values=['pending', 'running'])]) if not draining(worker)]
+
+
+def draining(worker):
+    return any(tag['Key'] == DrainingTag for tag in worker.tags or [])
+
+
+# 工作节点标记或取消即将关机
+def set_draining(worker_id, on):
+    worker = aws.ec2.Instance(worker_id)
+    if on:
+        worker.create_tags(Tags=[dict(Key=DrainingTag, Value='true')])
+    else:
+        worker.delete_tags(Tags=[dict(Key=DrainingTag)])
+
+
+# 启动一台工作节点，常驻领取任务，空闲超时后关机即终止
+def launch_worker(az, image, version_):
+    user_data = '#!/bin/bash\ncd /home/ec2-user/ShrinkEbs\npython3 shrink.py -W -o a -o s'
+    user_data += ' -o b' if 'b' in cfg.args.omit else ''
+    user_data += ' -n' if cfg.args.incremental else ''
+    user_data += ' -B' if cfg.args.block else ''
+    user_data += ' -H' if cfg.args.hydrate else ''
+    user_data += ' -P' if cfg.args.boost else ''
+    user_data += ' --mkfs %s' % cfg.MkfsProfile
+    user_data += ' -w %d' % cfg.CopyWorkers
+    user_data += ' -c %d' % cfg.RepCapacity if cfg.RepCapacity else ''
+    self = aws.ec2.Instance(cfg.instance['instanceId'])
+    worker = aws.ec2.create_instances(InstanceType=WorkerType, MaxCount=1, MinCount=1, EbsOptimized=True,
+                                      ImageId=image.id,
+                                      IamInstanceProfile=dict(Arn=self.iam_instance_profile['Arn']),
+                                      Placement={'AvailabilityZone': az},
+                                      UserData='%s\nsudo shutdown -h now\n' % user_data,
+                                      InstanceInitiatedShutdownBehavior='terminate',
+                                      )[0]
+    worker.create_tags(Tags=[dict(Key='Name', Value='ShrinkWorker'),
+                             dict(Key='Project', Value='ShrinkVolume'),
+                             dict(Key='Version', Value=version_),
+                             ])
+    return worker
+
+
+# 集群模式的控制节点
+def master():
+    cfg.log.info('===Shrink Master Node is starting to dispatch task to worker node===')
+    version_ = version()
+    image = worker_image(version_)
+    if not image:
+        return
+
+    plans, workers, launched = plan(), {}, 0
+    for az, items in plans.items():
+        warm = warm_workers(az, version_)
+        workers[az] = []
+        for item in items:
+            if warm:
+                worker = warm.pop(0)
+                cfg.log.info('%s(warm worker) reused' % worker.id)
+            else:
+                worker = launch_worker(az, image, version_)
+                launched += 1
+            ids = ','.join(instance.id for instance in item['targets'])
+            for instance in item['targets']:  # 工作节点按此标签领取任务
+                instance.create_tags(Tags=[dict(Key='ShrinkingBy', Value=worker.id)])
+            worker.reload()
+            if draining(worker):  # 分派时恰好开始关机，改派给新启动的工作节点
+                cfg.log.info('%s(warm worker) is draining, dispatching to a new worker' % worker.id)
+                worker = launch_worker(az, image, version_)
+                launched += 1
+                for instance in item['targets']:
+                    instance.create_tags(Tags=[dict(Key='ShrinkingBy', Value=worker.id)])
+            workers[az].append(worker.id)
+            cfg.log.info('%s(worker) is going to shrink volumes of %d targets in about %ds: %s' %
+                         (worker.id, len(item['targets']), item['seconds'], ids))
+    save(plans, workers)
+
+    # clear_image(image)
+    cfg.log.info('===%s ShrinkWorker dispatched(%d launched)... Master Node terminated normally===' %
+                 (sum(len(ids) for ids in workers.values()), launched))
+
+
+def clear_image(image):
+    snapshots = [aws.ec2.Snapshot(device['Ebs']['SnapshotId']) for device in image.block_device_mappings]
+    image.deregister()
+    [snapshot.delete() for snapshot in snapshots]
+    cfg.log.info('%s and %s deleted.' % (image.id, [s.id for s in snapshots]))
+
+
+if __name__ == '__main__':
+    pass
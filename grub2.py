@@ -4,12 +4,18 @@
 # @Author: Bai Yanzheng
 # @Date  : 2020/4/13
 # @Desc  : 复制原盘内核等启动信息，制作grub2 boot loader.
+# 以本机/boot为模板加上原盘的kernel、initrd准备boot目录，按kernel和initrd的哈希缓存，
+# 同一系列AMI的多块系统盘共用一份，各盘只写自己的grub.cfg，可并行处理
 #
 
 import os
 import datetime
+import hashlib
+import tempfile
+import threading
 import config as cfg
 import linux
+import timeline
 
 
 # 获取grub1/grub2启动的kernel等配置信息
@@ -42,41 +48,86 @@ BootLoaders = [
 Grub2Header = '#\n# grub2 config for Shrink Tool\n# Created on %s by shrink.py\n#\n\n' % datetime.date.today()
 
 default_kernelopts = ''  # 有的配置只有这样一行，写kernel的参数，命令在另外文件里
+BootCache = 'boot-cache'  # 准备好的boot目录缓存，在cfg.WorkPath下，按kernel和initrd的哈希分目录
 
+locks = {}  # {哈希: 锁}，同一份boot目录只准备一次
+locks_lock = threading.Lock()
+
+
+# 执行命令，失败时抛出异常，以免没有boot loader的新盘被当作成功
+def check_run(argv, **kwargs):
+    result = linux.run(argv, **kwargs)
+    if result.code:
+        raise UserWarning('%s failed with exit code %d' % (argv[0], result.code))
+    return result
 
-# 创建grub.cfg文件
-def create_config(grub_cfg, uuid):
-    header = Grub2Header + 'UUID=%s\nKERNAL="%s"\nIMG="%s"\n' % (uuid, grub_cfg['kernel'], grub_cfg['boot'])
-    tmp_config, dst_config = os.path.join(cfg.WorkPath, 'grub.cfg'), os.path.join(cfg.WorkPath, 'boot/grub2/grub.cfg')
-    linux.cmd('rm -f %s' % tmp_config) if os.path.exists(tmp_config) else None
 
-    with open(tmp_config, 'w', encoding='utf-8') as fp:
+# 创建grub.cfg文件，每块盘先写自己的临时文件
+def create_config(grub_cfg, uuid, dst_config):
+    header = Grub2Header + 'UUID=%s\nKERNAL="%s"\nIMG="%s"\n' % (uuid, grub_cfg['kernel'], grub_cfg['boot'])
+    with tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=cfg.WorkPath, prefix='grub-', delete=False) as fp:
         fp.write(header)
-        content = open('./grub.cfg', 'r', encoding='utf-8').read()
-        fp.write(content)
-    linux.cmd('sudo chmod 600 %s && sudo chown root:root %s && sudo mv -f %s %s' %
-              (tmp_config, tmp_config, tmp_config, dst_config))
+        fp.write(open('./grub.cfg', 'r', encoding='utf-8').read())
+    check_run(['chmod', '600', fp.name])
+    check_run(['chown', 'root:root', fp.name])
+    check_run(['mv', '-f', fp.name, dst_config])
+
+
+def key_lock(key):
+    with locks_lock:
+        return locks.setdefault(key, threading.Lock())
+
+
+# 准备含原盘kernel、initrd的boot目录，已有相同哈希的直接复用
+def prepare_boot(mount_point, files):
+    """
+    :param mount_point: 新盘分区的挂载点，已复制好原盘数据
+    :param files: kernel、initrd等文件相对分区根的路径，如boot/vmlinuz-...
+    :return: 缓存中的boot目录
+    """
+    sums = [line.split()[0] for line in check_run(['sha256sum'] + [os.path.join(mount_point, f) for f in files],
+                                                    echo=False).stdout.splitlines() if line]
+    if len(sums) != len(files):
+        raise UserWarning('sha256sum of %s incomplete' % ', '.join(files))
+    key = hashlib.sha256(' '.join(sums).encode('utf-8')).hexdigest()[:16]
+    cache = os.path.join(cfg.WorkPath, BootCache)
+    path = os.path.join(cache, key)
+    with key_lock(key):
+        if os.path.exists(path):
+            return os.path.join(path, 'boot')
+        None if os.path.exists(cache) else os.makedirs(cache)
+        staging = tempfile.mkdtemp(dir=cache, prefix='staging-')
+        try:
+            check_run(['cp', '-a', os.path.join(cfg.WorkPath, 'boot'), os.path.join(staging, 'boot')])
+            for file_ in files:
+                check_run(['cp', '-a', os.path.join(mount_point, file_), os.path.join(staging, file_)])
+            check_run(['mv', staging, path])  # 准备完成才出现在缓存中
+        except Exception:  # 不完整的目录不能留在缓存中，缓存跨次运行复用
+            linux.run(['rm', '-rf', staging])
+            raise
+        cfg.log.info('boot directory with %s prepared in %s' % (', '.join(files), path))
+    return os.path.join(path, 'boot')
 
 
 # 安装grub2的boot loader
+@timeline.span('grub')
 def install_boot_loader(dev, mount_point, uuid):
     for boot_loader in BootLoaders:
         config_file = os.path.join(mount_point, boot_loader['cfg'])
         if not os.path.exists(config_file):
             continue
         result = boot_loader['prog'](config_file, boot_loader['result'])  # 找到原grub的配置文件，抽出内核文件等信息
-        for command in result.values():  # 复制kernel等文件
+        files = []
+        for command in result.values():  # kernel等文件
             file_from = command.strip().split(maxsplit=1)[0].strip('/').strip('\\')
-            file_to = os.path.join(cfg.WorkPath, file_from)
-            file_from = os.path.join(mount_point, file_from)
-            if not os.path.exists(file_from):
-                raise UserWarning('%s not found.' % file_from)
-            linux.cmd('sudo \cp %s %s' % (file_from, file_to))
-        create_config(result, uuid)  #
+            if not os.path.exists(os.path.join(mount_point, file_from)):
+                raise UserWarning('%s not found.' % os.path.join(mount_point, file_from))
+            files.append(file_from)
+        boot = prepare_boot(mount_point, files)
         path = os.path.join(mount_point, 'boot')
-        linux.cmd('sudo rm -rf %s' % path)
-        linux.cmd('sudo cp -r %s %s' % (os.path.join(cfg.WorkPath, 'boot'), path))
-        linux.cmd('sudo grub2-install --boot-directory=%s %s' % (path, dev))
+        check_run(['rsync', '-a', '--delete', boot + '/', path + '/'])  # 与原盘相同的kernel等文件不再复制
+        create_config(result, uuid, os.path.join(path, 'grub2/grub.cfg'))
+        check_run(['grub2-install', '--boot-directory=%s' % path, dev])
         break
     else:
         raise UserWarning('No supported boot loader found.')
@@ -10,6 +10,11 @@ sudo ln -s -f python3 python
 sudo ln -s -f pip3 pip
 sudo pip install boto3
 
+# xfsdump/xfsrestore for copying XFS partitions, the rest (rsync, e2fsprogs, xfsprogs, grub2) are in the AMI
+sudo yum -y install xfsdump
+# optional: ntfsclone for NTFS partitions that cannot be mounted, otherwise they are copied block by block
+# sudo amazon-linux-extras install -y epel && sudo yum -y install ntfsprogs
+
 #  install and config aws cloud watch agent
 cd
 wget https://s3.cn-north-1.amazonaws.com.cn/amazoncloudwatch-agent/amazon_linux/amd64/latest/amazon-cloudwatch-agent.rpm
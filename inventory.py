@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @File  : inventory.py
+# @Author: Bai Yanzheng
+# @Date  : 2026/10/18
+# @Desc  : 批量获取实例及其磁盘清单
+# 用分页的describe_instances/describe_volumes一次取回全部匹配实例和挂在其上的磁盘，
+# 以Describe结果预置boto3资源对象的属性，之后读state、size、attachments等不再逐个load；
+# 状态变化由waiter在等待时刷新对应对象，清单本身只在重新获取时整体替换
+#
+
+import aws
+import waiter
+
+volumes = {}  # {instance_id: [volume]}，最近一次获取的各实例磁盘
+
+
+# 按Describe结果构造资源对象，免去首次访问属性时的load
+def resource(factory, identifier, data):
+    item = factory(identifier)
+    item.meta.data = data
+    return item
+
+
+# 获取匹配的实例，并批量预取它们的磁盘
+def get_instances(filters):
+    """
+    :param filters: describe_instances的Filters
+    :return: [instance]
+    """
+    instances = []
+    paginator = aws.client_ec2.get_paginator('describe_instances')
+    for page in paginator.paginate(Filters=filters):
+        for reservation in page['Reservations']:
+            for data in reservation['Instances']:
+                instances.append(resource(aws.ec2.Instance, data['InstanceId'], data))
+    prefetch(instances)
+    return instances
+
+
+# 批量获取一组实例上挂载的磁盘，每次Describe最多带waiter.MaxFilterValues个实例
+def prefetch(instances):
+    ids = [instance.id for instance in instances]
+    for instance_id in ids:
+        volumes[instance_id] = []
+    paginator = aws.client_ec2.get_paginator('describe_volumes')
+    for i in range(0, len(ids), waiter.MaxFilterValues):
+        filters = [dict(Name='attachment.instance-id', Values=ids[i:i + waiter.MaxFilterValues])]
+        for page in paginator.paginate(Filters=filters):
+            for data in page['Volumes']:
+                for attachment in data['Attachments']:
+                    if attachment['InstanceId'] in volumes:
+                        volumes[attachment['InstanceId']].append(resource(aws.ec2.Volume, data['VolumeId'], data))
+
+
+# 实例上的磁盘，未预取的即时获取
+def get_volumes(instance):
+    if instance.id not in volumes:
+        prefetch([instance])
+    return volumes[instance.id]
+
+
+if __name__ == '__main__':
+    pass
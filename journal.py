@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @File  : journal.py
+# @Author: Bai Yanzheng
+# @Date  : 2026/10/18
+# @Desc  : 缩容日志，记录每块盘所处阶段及相关的原盘、新盘、临时盘ID，存于cfg.WorkPath下的sqlite文件
+# 本机崩溃或重启后据此续做：已分区的新盘保留已复制的数据，只从原盘增量同步；
+# 其余阶段的清理临时盘后从头缩容。盘挂回原处后删除记录
+#
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import aws
+import config as cfg
+
+JournalFile = 'journal.db'
+Resumable = ('partitioned', 'copied')  # 新盘已分区，可增量续做的阶段
+"""
+stage:
+    seeding     两阶段缩容，等待快照恢复临时盘，原盘仍在原机
+    seeded      临时盘已就绪
+    stopping    开始停机摘盘，detached为False时原机可能已停、部分原盘已摘下，续做时挂回原盘并启动
+    detached    原盘已从原机摘下
+    restored    快照缩容，快照已恢复为临时盘
+    created     新盘已创建
+    partitioned 新盘已分区、建好文件系统，开始复制
+    copied      复制完成，等待挂回
+"""
+
+db = None
+lock = threading.Lock()
+
+
+def setup():
+    global db
+    db = sqlite3.connect(os.path.join(cfg.WorkPath, JournalFile), check_same_thread=False, isolation_level=None)
+    db.execute('CREATE TABLE IF NOT EXISTS volumes '
+               '(origin TEXT PRIMARY KEY, stage TEXT, instance TEXT, dup TEXT, detail TEXT, updated REAL)')
+
+
+# 记录磁盘进入某阶段，stage为空时只更新其他信息
+def save(volume, stage=None):
+    """
+    :param volume: cfg.volumeRepository中的磁盘
+    :param stage: 见上方stage说明
+    """
+    volume['stage'] = stage or volume.get('stage', '')
+    partitions = [{k: p[k] for k in ('uuid', 'label', 'type', 'size', 'raw', 'block') if k in p}
+                  for p in volume.get('partitions', [])]
+    detail = dict(dev=volume.get('dev', ''), state=volume.get('state', ''), detached=volume.get('detached', True),
+                  image=resource_id(volume, 'image'), seed=resource_id(volume, 'seed'),
+                  snapshot=resource_id(volume, 'snapshot'), boost=volume.get('boost', {}), partitions=partitions)
+    with lock:
+        db.execute('INSERT OR REPLACE INTO volumes VALUES (?, ?, ?, ?, ?, ?)',
+                   (volume['origin'].id, volume['stage'], resource_id(volume, 'instance'), resource_id(volume, 'dup'),
+                    json.dumps(detail), time.time()))
+
+
+def resource_id(volume, key):
+    return volume[key].id if volume.get(key, '') else ''
+
+
+# 磁盘已挂回原处，删除记录
+def finish(volume):
+    with lock:
+        db.execute('DELETE FROM volumes WHERE origin = ?', (volume['origin'].id,))
+
+
+# 能否增量续做：按块复制的分区在复制完成前没有文件系统或只写了一半，只能从头做
+def resumable(volume):
+    if volume['stage'] not in Resumable:
+        return False
+    return volume['stage'] == 'copied' or not any(p.get('block', False) for p in volume.get('partitions', []))
+
+
+# 读出上次未完成的磁盘，还原为cfg.volumeRepository中的格式，同机磁盘共用一个实例对象
+def load():
+    with lock:
+        rows = db.execute('SELECT origin, stage, instance, dup, detail FROM volumes ORDER BY updated').fetchall()
+    volumes, instances = [], {}
+    for origin, stage, instance_id, dup, detail in rows:
+        detail = json.loads(detail)
+        volume = dict(origin=aws.ec2.Volume(origin), stage=stage, dev=detail['dev'], state=detail['state'],
+                      detached=detail['detached'], partitions=detail['partitions'])
+        if instance_id:
+            volume['instance'] = instances.setdefault(instance_id, aws.ec2.Instance(instance_id))
+        if detail['image']:
+            volume['image'] = aws.ec2.Image(detail['image'])
+        if detail.get('boost', ''):
+            volume['boost'] = detail['boost']
+        if dup:
+            volume['dup'] = aws.ec2.Volume(dup)
+        if detail['seed']:
+            volume['seed'] = aws.ec2.Volume(detail['seed'])
+        if detail['snapshot']:
+            volume['snapshot'] = aws.ec2.Snapshot(detail['snapshot'])
+        volumes.append(volume)
+    return volumes
+
+
+if __name__ == '__main__':
+    pass
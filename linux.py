@@ -6,157 +6,629 @@
 # @Desc  : 对EC2磁盘或快照缩容到实际占用空间的1.2倍
 #
 
+import collections
+import ctypes
 import os
+import re
+import select
+import signal
+import threading
 import time
-from subprocess import Popen, PIPE
+from concurrent.futures import ThreadPoolExecutor
+from subprocess import Popen, PIPE, DEVNULL
 
 import aws
 import config as cfg
+import copier
 import grub2
+import journal
+import timeline
 
-NotErrs = ('mke2fs 1.42.9 (28-Dec-2013)\n',
-           'Installing for i386-pc platform.\nInstallation finished. No error reported.\n')
+NotErrs = ('mke2fs 1.42.9 (28-Dec-2013)',
+           'Installing for i386-pc platform.', 'Installation finished. No error reported.')
 
+Result = collections.namedtuple('Result', 'code stdout elapsed')
+processes = set()  # 运行中的子进程，取消时全部结束
+processes_lock = threading.Lock()
+cancelled = threading.Event()
+timings = {}  # 各命令累计的{程序名: [次数, 秒数]}
+KillGrace = 10  # 结束命令时SIGTERM后等待的秒数，仍未退出再SIGKILL
 
-# 拼成linux设备号
-def device_name(device_no):
-    return '/dev/sd%s' % chr(device_no + 102)
 
+# 可供本机挂盘的设备名
+DeviceNames = ['/dev/sd%s' % c for c in 'fghijklmnopqrstuvwxyz'] + \
+              ['/dev/xvd%s%s' % (b, c) for b in 'bc' for c in 'abcdefghijklmnopqrstuvwxyz']
 
-# 拼成linux设备挂载点
-def mount_point(device_no):
-    return os.path.join(cfg.WorkPath, chr(device_no + 102))
+devices = set()  # 空闲设备名
+devices_lock = threading.Lock()
+
+
+# 初始化空闲设备名，去掉本机已占用的
+def setup_devices(used):
+    global devices
+    devices = set(DeviceNames) - set(used)
+
+
+# 分配一个空闲设备名
+def alloc_device():
+    with devices_lock:
+        device = min(devices, key=DeviceNames.index)
+        devices.remove(device)
+    return device
+
+
+def free_device(device):
+    attached.pop(device, None)
+    with devices_lock:
+        devices.add(device)
+
+
+# 归还设备名：出错未能摘下、盘仍挂在本机该设备名上的不归还，以免下一块盘挂载失败
+def release_device(device):
+    volume_id = attached.get(device, '')
+    if volume_id and aws.attached_to(volume_id, cfg.instance['instanceId'], device):
+        cfg.log.warning('%s is still attached as %s, the device name is withheld' % (volume_id, device))
+        return
+    free_device(device)
+
+
+# 挂盘时指定的设备名对应的本机块设备：Nitro实例上按盘ID找NVMe设备，Xen实例上/dev/sdf显示为/dev/xvdf，
+# aliases可指定其他映射
+aliases = {}
+attached = {}  # {挂盘设备名: 盘ID}
+ByIdPrefix = '/dev/disk/by-id/nvme-Amazon_Elastic_Block_Store_'
+InotifyEvents = 0x100 | 0x80 | 0x4  # IN_CREATE | IN_MOVED_TO | IN_ATTRIB
+
+
+def block_device(device):
+    if device in aliases:
+        return aliases[device]
+    nvme = nvme_device(attached[device]) if device in attached else None
+    if nvme:
+        return nvme
+    xvd = device.replace('/dev/sd', '/dev/xvd')
+    return xvd if not os.path.exists(device) and os.path.exists(xvd) else device
+
+
+# 盘ID对应的NVMe设备，NVMe序列号即去掉'-'的盘ID，先找udev的by-id链接，再查sysfs
+def nvme_device(volume_id):
+    serial = volume_id.replace('-', '')
+    if os.path.exists(ByIdPrefix + serial):
+        return os.path.realpath(ByIdPrefix + serial)
+    for name in os.listdir('/sys/block') if os.path.isdir('/sys/block') else []:
+        try:
+            with open('/sys/block/%s/device/serial' % name, 'r') as fp:
+                if fp.read().strip() == serial:
+                    return '/dev/%s' % name
+        except OSError:
+            continue
+    return None
+
+
+# 等到ready()成立或超时：/dev下有设备节点、链接创建时(inotify)重新检查，取不到inotify时短间隔轮询
+def wait_dev(ready, timeout=None):
+    deadline = time.time() + (timeout or cfg.DeviceTimeout)
+    fd = inotify(['/dev', '/dev/disk/by-id'])
+    try:
+        while not ready():
+            left = deadline - time.time()
+            if left <= 0:
+                return False
+            if fd is None:
+                time.sleep(min(0.1, left))
+            elif select.select([fd], [], [], left)[0]:
+                os.read(fd, 65536)  # 事件只用于唤醒
+    finally:
+        os.close(fd) if fd is not None else None
+    return True
+
+
+def inotify(paths):
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    for path in paths:
+        libc.inotify_add_watch(fd, path.encode('utf-8'), InotifyEvents) if os.path.isdir(path) else None
+    return fd
+
+
+# 盘已挂到本机，等待其块设备及分区设备就绪
+def wait_device(device, volume):
+    attached[device] = volume.id
+    if not wait_dev(lambda: os.path.exists(block_device(device))):
+        raise UserWarning('%s(%s) not found on this server' % (device, volume.id))
+    run(['udevadm', 'settle', '--timeout=%d' % cfg.DeviceTimeout], timeout=cfg.CommandTimeout)  # 分区设备随后由udev建立
+
+
+# 盘挂到本机并等待就绪
+def attach_local(volume, device):
+    aws.attach_volume(volume, device, cfg.instance['instanceId'])
+    wait_device(device, volume)
+
+
+# 磁盘上第n个分区的设备名，/dev/sdf1, /dev/loop0p1
+def partition_device(disk, n):
+    return '%s%s%d' % (disk, 'p' if disk[-1].isdigit() else '', n)
+
+
+# 设备挂载点
+def mount_point(device):
+    return os.path.join(cfg.WorkPath, os.path.basename(device))
 
 
 # 执行linux命令并返回标准输出
-def cmd(command):
-    cfg.log.info(command.replace('\n', '\\n'))
-    process = Popen(command, shell=True, stdout=PIPE, stderr=PIPE)
-    stdout, stderr = process.communicate()
-    stdout, stderr = stdout.decode('utf-8', 'ignore'), stderr.decode('utf-8', 'ignore')
-    cfg.log.info(stdout[-100:]) if stdout else None
-    cfg.log.error(stderr) if stderr and stderr not in NotErrs else None
-    return stdout
+# argv列表不经过shell直接执行，本身是root时不加sudo；stdout逐行写入日志，stderr逐行记为错误
+def run(argv, sudo=True, timeout=None, stdin=None, echo=True):
+    """
+    :param argv: ['mount', '/dev/sdf1', '/tmp/shrink/sdf/1']
+    :param sudo: 需要root权限
+    :param timeout: 超时秒数，超时结束进程
+    :param stdin: 写入标准输入的文本
+    :param echo: 输出是否写入日志，输出很多时关闭
+    :return: Result(code=, stdout=, elapsed=)
+    """
+    argv = (['sudo'] if sudo and os.geteuid() != 0 else []) + [str(arg) for arg in argv]
+    command = ' '.join(argv)
+    if cancelled.is_set():
+        raise UserWarning('Cancelled: %s' % command)
+    cfg.log.info(command)
+    start = time.time()
+    process = Popen(argv, stdout=PIPE, stderr=PIPE, stdin=PIPE if stdin is not None else DEVNULL,
+                    start_new_session=True)
+    with processes_lock:
+        processes.add(process)
+    timer = threading.Timer(timeout, kill, args=(process,)) if timeout else None
+    timer.start() if timer else None
+    errors = threading.Thread(target=log_stderr, args=(process.stderr,))
+    errors.start()
+    if stdin is not None:
+        process.stdin.write(stdin.encode('utf-8'))
+        process.stdin.close()
+    lines = []
+    for line in process.stdout:
+        line = line.decode('utf-8', 'ignore')
+        lines.append(line)
+        cfg.log.info(line.rstrip('\n')) if echo and line.strip() else None
+    code = process.wait()
+    errors.join()
+    timer.cancel() if timer else None
+    with processes_lock:
+        processes.discard(process)
+        timing = timings.setdefault(os.path.basename(argv[1] if argv[0] == 'sudo' else argv[0]), [0, 0])
+        timing[0], timing[1] = timing[0] + 1, timing[1] + time.time() - start
+    level = cfg.log.info if code == 0 else cfg.log.error
+    level('exit %d in %.2fs: %s' % (code, time.time() - start, argv[1] if argv[0] == 'sudo' else argv[0]))
+    return Result(code, ''.join(lines), time.time() - start)
+
+
+def log_stderr(stream):
+    for line in stream:
+        line = line.decode('utf-8', 'ignore').rstrip('\n')
+        cfg.log.error(line) if line and line not in NotErrs else None
+
+
+# 执行管道producer | consumer，不经shell，两个命令的stderr都记为错误
+def pipe(producer, consumer, sudo=True, timeout=None):
+    """
+    :return: Result(code=, stdout=, elapsed=)，任一命令失败时code非0
+    """
+    prefix = ['sudo'] if sudo and os.geteuid() != 0 else []
+    producer, consumer = [prefix + [str(arg) for arg in argv] for argv in (producer, consumer)]
+    command = '%s | %s' % (' '.join(producer), ' '.join(consumer))
+    if cancelled.is_set():
+        raise UserWarning('Cancelled: %s' % command)
+    cfg.log.info(command)
+    start = time.time()
+    first = Popen(producer, stdout=PIPE, stderr=PIPE, stdin=DEVNULL, start_new_session=True)
+    try:
+        second = Popen(consumer, stdin=first.stdout, stdout=PIPE, stderr=PIPE, start_new_session=True)
+    except OSError:  # consumer不存在等，结束已启动的producer
+        first.kill()
+        first.wait()
+        raise
+    first.stdout.close()  # 只由consumer读，consumer退出时producer收到SIGPIPE
+    with processes_lock:
+        processes.update((first, second))
+    timer = threading.Timer(timeout, lambda: [kill(p) for p in (first, second)]) if timeout else None
+    timer.start() if timer else None
+    errors = [threading.Thread(target=log_stderr, args=(p.stderr,)) for p in (first, second)]
+    [thread.start() for thread in errors]
+    lines = [line.decode('utf-8', 'ignore') for line in second.stdout]
+    codes = first.wait(), second.wait()
+    [thread.join() for thread in errors]
+    timer.cancel() if timer else None
+    name = '%s|%s' % (os.path.basename(producer[len(prefix)]), os.path.basename(consumer[len(prefix)]))
+    with processes_lock:
+        processes.difference_update((first, second))
+        timing = timings.setdefault(name, [0, 0])
+        timing[0], timing[1] = timing[0] + 1, timing[1] + time.time() - start
+    code = codes[0] or codes[1]
+    level = cfg.log.info if code == 0 else cfg.log.error
+    level('exit %d,%d in %.2fs: %s' % (codes[0], codes[1], time.time() - start, name))
+    return Result(code, ''.join(lines), time.time() - start)
+
+
+# 结束命令：各命令在自己的进程组中，sudo会把SIGTERM转给命令，SIGKILL则无法转发，
+# 所以先向进程组发SIGTERM，KillGrace秒后仍未退出再SIGKILL(非root时只能杀掉sudo本身)
+def kill(process):
+    signal_group(process, signal.SIGTERM)
+    escalate = threading.Timer(KillGrace, lambda: signal_group(process, signal.SIGKILL) if process.poll() is None else None)
+    escalate.daemon = True
+    escalate.start()
+
+
+def signal_group(process, sig):
+    try:
+        os.killpg(process.pid, sig)
+    except OSError:  # 已退出，或组内只有无权发信号的root进程
+        try:
+            process.send_signal(sig)
+        except OSError:
+            pass
+
+
+# 取消：结束所有运行中的命令，之后不再启动新命令
+def cancel():
+    cancelled.set()
+    with processes_lock:
+        for process in processes:
+            kill(process)
+
+
+# 记录各命令累计耗时
+def report_timings():
+    for name, (count, seconds) in sorted(timings.items(), key=lambda item: item[1][1], reverse=True):
+        cfg.log.info('%s: %d times, %.1fs' % (name, count, seconds))
 
 
 # 在子线程中对某块磁盘进行缩容
-def shrink(idx_repository):
+def shrink(volume):
+    """
+    :param volume: cfg.volumeRepository中的磁盘，volume['devices']为其在本机的设备名
+    """
+    seeded, resumed = 'seed' in volume, volume.get('resumed', False)
+    try:
+        with timeline.span('copy', phase='seed' if seeded else 'resume' if resumed else 'full'):
+            success = copy(volume, final=not seeded, delta=resumed)  # 续做的新盘已有部分数据，增量同步
+        if success and seeded:  # 两阶段缩容：已从快照盘复制全量，停机后从原盘同步增量
+            umount_all(volume)
+            success = aws.swap_seed(volume, volume['devices']['source'])
+            relocate(volume) if success else None
+            with timeline.span('copy', phase='delta'):
+                success = success and copy(volume, final=True, delta=True)
+        journal.save(volume, 'copied') if success else None
+        if success and volume.get('boost', ''):
+            try:
+                aws.unboost(volume)
+            except Exception as err:  # 改不回不影响缩容结果，新盘保持gp3
+                cfg.log.warning('%s failed to modify back: %s' % (volume['dup'].id, err))
+    except Exception as err:
+        cfg.log.exception('Exception occurred, %s skipped to shrink.\n%s' % (err, volume['origin']))
+        success = False
+
+    # 摘下源盘及目标盘
+    umount_all(volume)
+    if volume.get('source', ''):
+        volume['source'].detach_from_instance()
+    volume['dup'].detach_from_instance()
+    cfg.log.info('%s(origin) and %s(dup) detached from shrinking server' % (volume['origin'].id, volume['dup'].id))
+
+    volume['result'] = volume['dup'] if success else volume['origin']
+    aws.wind_up(volume)
+
+
+# 原盘换下临时盘后等待就绪，重新定位源分区设备：Nitro上原盘的NVMe设备可能与临时盘不同
+def relocate(volume):
+    wait_device(volume['devices']['source'], volume['origin'])
+    partitions = get_partitions(volume['devices']['source'])
+    if [p['uuid'] for p in partitions] != [p['uuid'] for p in volume['partitions']]:
+        raise UserWarning('partitions of %s differ from its snapshot' % volume['origin'].id)
+    for partition, located in zip(volume['partitions'], partitions):
+        partition['dev'] = located['dev']
+
+
+# 逐个分区复制数据
+def copy(volume, final=True, delta=False):
     """
-    :param idx_repository: idx of volume in cfg.Repository
+    :param volume: cfg.volumeRepository中的磁盘
+    :param final: 是否最后一遍复制，最后一遍才做boot loader并改uuid/label
+    :param delta: 目标已有全量数据，只同步增量并删除源上已不存在的文件
+    :return: 是否成功
     """
-    volume = cfg.volumeRepository[idx_repository]
-    success = True
-    # rsync复制数据
     for partition in volume['partitions']:
         try:
-            if partition.get('raw', False):  # 无法mount的分区，dd直接复制
-                cmd('sudo dd if=%s of=%s' % (partition['dev'], partition['dupdev']))
+            if partition.get('raw', False):  # 无法mount的分区，按块复制
+                copier.raw(partition, delta)
+                continue
+            source_mp, dst_mp = partition['mp'], partition['dupmp']
+            fstype = partition.get('type', '')
+            blocked = partition.get('block', False) and not delta and block(volume, partition)
+            if not blocked and source_mp not in volume.get('mounts', []) and \
+                    not mount(volume, partition['dev'], source_mp, readonly=True, fstype=fstype):
+                raise UserWarning('failed to mount %s' % partition['dev'])
+            if not mount(volume, partition['dupdev'], dst_mp, fstype=fstype):
+                raise UserWarning('failed to mount %s' % partition['dupdev'])
+            if fstype == 'xfs' and not delta:  # XFS全量用xfsdump，增量仍用rsync
+                copier.xfs(source_mp, dst_mp)
+            elif not blocked:
+                copier.rsync(source_mp, dst_mp, delta)
+            if final and 'a' in volume['dev'] and os.path.exists('%s/boot' % dst_mp):  # 按需做boot loader
+                grub2.install_boot_loader(block_device(volume['devices']['dup']), dst_mp, partition['uuid'])
+            umount(volume, dst_mp)
+            if not final or fstype == 'xfs':  # XFS建文件系统时已指定uuid和label
                 continue
-            source_mp, dst_mp = mount_point(idx_repository), mount_point(idx_repository + cfg.RepCapacity)
-            cmd('sudo mount %s %s' % (partition['dev'], source_mp))
-            cmd('sudo mount %s %s' % (partition['dupdev'], dst_mp))
-            cmd('sudo rsync -a -r %s/ %s/' % (source_mp, dst_mp))
-            cmd('sudo umount %s' % source_mp)
-            if 'a' in volume['dev'] and os.path.exists('%s/boot' % dst_mp):  # 按需做boot loader
-                grub2.install_boot_loader(device_name(idx_repository + cfg.RepCapacity), dst_mp, partition['uuid'])
-            cmd('sudo umount %s' % dst_mp)
             # 目标分区uuid和label改为与源相同，保证正常挂载
             label = partition['label']
-            cmd('sudo tune2fs -U %s %s%s' %
-                (partition['uuid'], '-L %s ' % label if label else ' ', partition['dupdev']))
+            run(['tune2fs', '-U', partition['uuid']] + (['-L', label] if label else []) + [partition['dupdev']],
+                timeout=cfg.CommandTimeout)
         except Exception as err:
             cfg.log.exception('Exception occurred, %s%s skipped to shrink.\n%s' %
                               (err, partition['dev'], volume['origin']))
-            success = False
-            break
+            return False
+    return True
 
-    # 摘下源盘及目标盘
-    volume['origin'].detach_from_instance()
-    volume['dup'].detach_from_instance()
-    cfg.log.info('%s(origin) and %s(dup) detached from shrinking server' % (volume['origin'].id, volume['dup'].id))
 
-    volume['result'] = volume['dup'] if success else volume['origin']
-    aws.wind_up(idx_repository)
+# 按块缩容一个分区，源分区先卸载；新分区容不下时补建文件系统，返回False改用rsync
+def block(volume, partition):
+    umount(volume, partition['mp']) if partition['mp'] in volume.get('mounts', []) else None
+    with timeline.span('block', partition=partition['dev']):
+        if copier.block(partition):
+            return True
+    partition['block'] = False
+    mkfs(partition)
+    return False
+
+
+# 源盘是否可丢弃：两阶段缩容的临时盘、快照或AMI恢复的盘
+def disposable(volume):
+    return 'seed' in volume or not volume.get('instance', '')
+
+
+# 快照恢复的源盘在后台预读，与估算、复制同时进行
+def hydrate(volume, partitions):
+    if not cfg.args.hydrate or not disposable(volume):
+        return
+    stop = threading.Event()
+    thread = threading.Thread(target=hydrating, args=(volume['source'].id, partitions, stop),
+                              name='hydrate-%s' % volume['source'].id)
+    volume['hydrator'] = (thread, stop)
+    thread.start()
+
+
+def hydrating(volume_id, partitions, stop):
+    timeline.bind(volume=volume_id)
+    try:
+        with timeline.span('hydrate'):
+            copier.hydrate(partitions, stop)
+    except Exception as err:  # 预读失败不影响复制
+        cfg.log.warning('hydrate %s stopped: %s' % (volume_id, err))
+
+
+# 停止预读，摘源盘前调用
+def stop_hydrate(volume):
+    thread, stop = volume.pop('hydrator', (None, None))
+    if thread:
+        stop.set()
+        thread.join()
 
 
 # 源盘挂到本机，估算缩容容量，建新盘并挂载
-def attach(idx):
-    volume = cfg.volumeRepository[idx]
+def attach(volume):
     vol_origin = volume['origin']
-    dev_origin, dev_dup = device_name(idx), device_name(idx + cfg.RepCapacity)  # 组合设备文件/dev/sdf， dev/sdl
-    aws.attach_volume(vol_origin, dev_origin, cfg.instance['instanceId'])
+    source = volume['source'] = volume.get('seed', vol_origin)  # 两阶段缩容先读快照恢复的临时盘
+    dev_origin, dev_dup = volume['devices']['source'], volume['devices']['dup']
+    attach_local(source, dev_origin)
     partitions = get_partitions(dev_origin)
-    size = get_size(partitions, mount_point(idx))
-    usage_rate = size / vol_origin.size
+    hydrate(volume, partitions)
+    for idx, partition in enumerate(partitions):  # 每个分区有自己的挂载点，源分区挂载一次直到复制完成
+        partition['mp'] = os.path.join(mount_point(dev_origin), str(idx + 1))
+        partition['dupmp'] = os.path.join(mount_point(dev_dup), str(idx + 1))
+    size = get_size(volume, partitions)
+    if cfg.args.block and disposable(volume):  # ext分区按块缩容，新分区不建文件系统
+        for partition in partitions:
+            partition['block'] = not partition.get('raw', False) and partition['type'] in copier.Ext
+    usage_rate = size / source.size
     if usage_rate > 0.7:  # 太满的盘不缩，直接挂回， 该条件包含了无法mount的
-        cfg.volumeRepository[idx]['result'] = cfg.volumeRepository[idx]['origin']  # 不做，原盘挂回
+        volume['result'] = volume['origin']  # 不做，原盘挂回
         cfg.log.info('%s need not to shrink due to high usage(%d%%)' %(volume['origin'].id, usage_rate * 100))
-        aws.wind_up(idx)
+        umount_all(volume)
+        aws.wind_up(volume)
         return False
     size = max(size, cfg.MinVolumeSize)  # 保持不要太小
-    iops = 0 if vol_origin.volume_type != 'io1' else vol_origin.iops
-    volume_dup = aws.create_volume(VolumeType=vol_origin.volume_type, Size=size, Iops=iops)
-    volume_dup.create_tags(Tags=[{'Key': 'ShrinkFrom', 'Value': vol_origin.id}, ])
-    aws.attach_volume(volume_dup, dev_dup, cfg.instance['instanceId'])
-    volume['dup'], volume['partitions'] = volume_dup, partitions
+    final = aws.performance(vol_origin, size)
+    if cfg.args.boost and vol_origin.volume_type not in ('sc1', 'st1', 'standard'):  # 复制期间用高性能gp3，完成后改回
+        boost = aws.boost_settings(size)
+        volume_dup = aws.create_volume(Size=size, **boost)
+        volume_dup.create_tags(Tags=[{'Key': 'ShrinkFrom', 'Value': vol_origin.id},
+                                     {'Key': 'ShrinkBoost', 'Value': aws.boost_tag(boost)}])
+        volume['boost'] = final
+    else:
+        volume_dup = aws.create_volume(Size=size, **final)
+        volume_dup.create_tags(Tags=[{'Key': 'ShrinkFrom', 'Value': vol_origin.id}, ])
+    volume['dup'] = volume_dup
+    journal.save(volume, 'created')
+    attach_local(volume_dup, dev_dup)
+    volume['partitions'] = partitions
     return True
 
 
+# 续做上次中断的缩容：原盘和已分区的新盘挂到本机，新盘上已复制的数据保留
+def reattach(volume):
+    """
+    :param volume: journal.load()还原的磁盘，partitions中有上次的分区大小、是否无法mount；
+                   有按块复制分区且未复制完的不会续做，见journal.resumable()
+    """
+    source = volume['source'] = volume['origin']
+    dev_origin, dev_dup = volume['devices']['source'], volume['devices']['dup']
+    attach_local(source, dev_origin)
+    attach_local(volume['dup'], dev_dup)
+    partitions = get_partitions(dev_origin)
+    if len(partitions) != len(volume['partitions']):
+        raise UserWarning('partitions of %s changed since last run' % source.id)
+    for idx, (partition, last) in enumerate(zip(partitions, volume['partitions'])):
+        partition.update(size=last['size'], raw=last.get('raw', False),
+                         dupdev=partition_device(block_device(dev_dup), idx + 1),
+                         mp=os.path.join(mount_point(dev_origin), str(idx + 1)),
+                         dupmp=os.path.join(mount_point(dev_dup), str(idx + 1)))
+    volume.update(partitions=partitions, resumed=True)
+    hydrate(volume, partitions)
+    cfg.log.info('%s resumed with %s(dup) from stage %s' % (source.id, volume['dup'].id, volume['stage']))
+
+
 # 获取磁盘中需要复制的分区(去掉启动分区）
 def get_partitions(device):
     """
     :param device: '/dev/sdf'
-    :return: [dict(dev=dev, uuid=source.get('UUID', ''), label=source.get('LABEL', ''))]
+    :return: [dict(dev=dev, uuid=source.get('UUID', ''), label=source.get('LABEL', ''), type=source.get('TYPE', ''))]
     """
     partitions = []
-    lines = cmd('sudo fdisk --b -l %s|grep -v Disk|grep -v BIOS|grep %s' % (device, device)).strip('\n').split('\n')
+    device = block_device(device)
+    lines = run(['fdisk', '--bytes', '-l', device], timeout=cfg.CommandTimeout).stdout.split('\n')
+    lines = [line for line in lines if device in line and 'Disk' not in line and 'BIOS' not in line]
     lines = [line for line in lines if line and '4095' not in line.split()]
     for line in lines:
         fields = line.split()
         dev, size = fields[0], int(int(fields[4]) / 1048576) + 1  # 4的位置为不是所有时候都对TBD dos的多一个字段
-        fields = {field.split('=')[0]: field.split('=')[-1].strip('"') for field in cmd('sudo blkid %s' % dev).split()}
-        partitions.append(dict(dev=dev, uuid=fields.get('UUID', ''), label=fields.get('LABEL', ''), size=size))
+        fields = {field.split('=')[0]: field.split('=')[-1].strip('"') for field in run(['blkid', dev], timeout=cfg.CommandTimeout).stdout.split()}
+        partitions.append(dict(dev=dev, uuid=fields.get('UUID', ''), label=fields.get('LABEL', ''),
+                               type=fields.get('TYPE', ''), size=size))
     return partitions
 
 
-# mount源分区，计算缩容后所需总容量
-def get_size(partitions, mount_point_):
+# 只读mount源分区并保持挂载，按已用空间计算缩容后所需总容量
+@timeline.span('sizing')
+def get_size(volume, partitions):
     """
-    :param partitions: [dict(dev=, uuid=, label=)]
-    :param mount_point_: '/dev/sdf'
+    :param volume: cfg.volumeRepository中的磁盘，记录挂载
+    :param partitions: [dict(dev=, uuid=, label=, mp=)]
     :return: dest size(GB), partitions: [dict(dev=, uuid=, label=, size=)]
     """
     for partition in partitions:
-        cmd('sudo mount %s %s' % (partition['dev'], mount_point_))
-        msg = cmd('sudo df -m %s|grep /dev/' % partition['dev']).split()
-        if len(msg) < 2:  # 磁盘没有mount上，无文件系统等原因，本分区不处理
-            partition['raw'] = True
-        else:
-            partition['size'] = int(int(msg[2]) * cfg.ExpandFactor) + 1  # MB
-        cmd('sudo umount %s' % mount_point_)
+        if not mount(volume, partition['dev'], partition['mp'], readonly=True, fstype=partition['type']):
+            partition['raw'] = True  # 无文件系统等原因mount不上，按块复制
+            continue
+        stat = os.statvfs(partition['mp'])
+        used = (stat.f_blocks - stat.f_bfree) * stat.f_frsize
+        partition['size'] = int(used / 1048576 * cfg.ExpandFactor) + 1  # MB
+        if partition['type'] == 'xfs':
+            partition['size'] = max(partition['size'], cfg.XfsMinSize)
     return int(sum(partition['size'] for partition in partitions) / 1024) + 1  # GB
 
 
+# 挂载分区并记入volume['mounts']，以便出错时也能全部卸载
+# XFS不允许同时挂载UUID相同的文件系统，源盘与本机系统盘、新盘与源盘的UUID可能相同，用nouuid
+def mount(volume, device, mount_point_, readonly=False, fstype=''):
+    None if os.path.exists(mount_point_) else os.makedirs(mount_point_)
+    options = (['ro'] if readonly else []) + (['nouuid'] if fstype == 'xfs' else [])
+    run(['mount'] + (['-o', ','.join(options)] if options else []) + [device, mount_point_], timeout=cfg.CommandTimeout)
+    if not os.path.ismount(mount_point_):
+        return False
+    volume.setdefault('mounts', []).append(mount_point_)
+    return True
+
+
+def umount(volume, mount_point_):
+    run(['umount', mount_point_], timeout=cfg.CommandTimeout)
+    volume['mounts'].remove(mount_point_)
+
+
+# 卸载本盘在本机上的所有挂载，摘盘前或出错时调用，同时停止预读
+def umount_all(volume):
+    stop_hydrate(volume)
+    for mount_point_ in list(reversed(volume.get('mounts', []))):
+        umount(volume, mount_point_)
+
+
+BiosBoot = '21686148-6449-6E6F-744E-656564454649'  # GPT分区类型
+LinuxFilesystem = '0FC63DAF-8483-4772-8E79-3D69D8477DE4'
+TransientFeatures = ('needs_recovery', 'orphan_present', '(none)')  # 运行状态标志，不是可在mkfs时指定的特性
+
+
 # 新盘建分区和文件系统
-def fdisk(vol_idx, partitions):
+def fdisk(device, partitions):
     """
-    :param vol_idx: 102-f,103-g
+    :param device: '/dev/sdg'
     :param partitions: [dict(dev=, uuid=, label=, size=)]
     :return: partitions: [dict(dev=, uuid=, label=, size=, dupdev=)]
     """
-    device = device_name(vol_idx)
-    txt = 'g\nn\n128\n2048\n4095\nt\n4\n'
+    # 一次写入GPT分区表：128号BIOS boot分区在最前，其余按源分区依次排列，最后一个占满剩余空间
+    disk = block_device(device)
+    script = 'label: gpt\n%s : start=2048, size=2048, type=%s\n' % (partition_device(disk, 128), BiosBoot)
     for idx, partition in enumerate(partitions):
-        txt += 'n\n%d\n\n+%dM\n' % (idx + 1, partition['size']) \
-            if idx < len(partitions) - 1 else 'n\n%d\n\n\n' % (idx + 1)
-        partition['dupdev'] = '%s%d' % (device, idx + 1)
-    txt += 'w\n'
-    cmd('sudo echo "%s"|sudo fdisk %s' % (txt, device))
-    time.sleep(5)
-    for idx, partition in enumerate(partitions):
-        if partition.get('raw', False):  # 源分区无法mount的，不做文件系统
-            continue
-        cmd('sudo mkfs -t ext4 %s' % partition['dupdev'])
+        partition['dupdev'] = partition_device(disk, idx + 1)
+        size = 'size=%dMiB, ' % partition['size'] if idx < len(partitions) - 1 else ''
+        script += '%s : %stype=%s\n' % (partition['dupdev'], size, LinuxFilesystem)
+    with timeline.span('fdisk'):
+        run(['sfdisk', '--wipe', 'always', disk], stdin=script, timeout=cfg.CommandTimeout)
+        if not wait_dev(lambda: all(os.path.exists(p['dupdev']) for p in partitions)):
+            raise UserWarning('partitions of %s not found' % device)
+    todo = [p for p in partitions if not p.get('raw', False) and not p.get('block', False)]  # 按块复制的，不做文件系统
+    with ThreadPoolExecutor(max_workers=max(len(todo), 1)) as executor:
+        list(executor.map(mkfs, todo))
+
+
+# 新分区建文件系统，ext、XFS沿用源分区的类型和特性，XFS同时沿用uuid和label
+def mkfs(partition):
+    with timeline.span('mkfs', partition=partition['dupdev']):
+        if not run(mkfs_command(partition)).code:
+            return
+        # 本机e2fsprogs/xfsprogs较旧，不认识源分区的某些特性(如metadata_csum、orphan_file)，改用本机默认特性
+        cfg.log.warning('mkfs %s with features of %s failed, retrying with defaults' % (partition['dupdev'], partition['dev']))
+        if run(mkfs_command(partition, features=False)).code:
+            raise UserWarning('mkfs %s failed' % partition['dupdev'])
+
+
+def mkfs_command(partition, features=True):
+    if partition.get('type', '') == 'xfs':
+        label, options = partition.get('label', ''), xfs_options(partition) if features else {}
+        options['m'] = ['uuid=%s' % partition['uuid']] + options.get('m', [])
+        return (['mkfs.xfs', '-f'] + (['-L', label] if label else []) + cfg.XfsProfiles[cfg.MkfsProfile] +
+                sum([['-%s' % k, ','.join(v)] for k, v in sorted(options.items()) if v], []) + [partition['dupdev']])
+    fstype = partition['type'] if partition.get('type', '') in copier.Ext else 'ext4'
+    return ['mkfs', '-t', fstype] + mkfs_options(partition, features) + [partition['dupdev']]
+
+
+# XFS源分区的特性原样沿用，较新的xfsprogs默认开启reflink、bigtime、inobtcount等，旧内核(RHEL7、AL2)无法mount；
+# 源分区已由get_size挂载，旧版xfs_info只接受挂载点
+def xfs_options(partition):
+    """
+    :return: {mkfs.xfs选项: [子选项]}，如dict(m=['crc=1', 'finobt=1'], i=['size=512'], n=['ftype=1'])
+    """
+    result = run(['xfs_info', partition['mp']], echo=False, timeout=cfg.CommandTimeout)
+    fields = {}
+    for key, value in re.findall(r'([\w-]+)=([^\s,]+)', result.stdout):
+        fields.setdefault(key, value)  # bsize等在各段重复出现，这里只用首次出现的
+    if result.code or 'crc' not in fields:
+        return {}
+    options = dict(m=['%s=%s' % (k, fields[k]) for k in ('crc', 'finobt', 'rmapbt', 'reflink', 'bigtime', 'inobtcount')
+                      if k in fields],
+                   i=['size=%s' % fields['isize']] if 'isize' in fields else [],
+                   n=['ftype=%s' % fields['ftype']] if 'ftype' in fields else [])
+    options['i'] += ['sparse=%s' % fields['sparse']] if 'sparse' in fields else []
+    return options
+
+
+# ext源分区的块大小、inode大小、特性原样沿用，inode数按源的比例，且不少于已用inode数的cfg.ExpandFactor倍
+def mkfs_options(partition, features=True):
+    options = list(cfg.MkfsProfiles[cfg.MkfsProfile])
+    if partition.get('type', '') not in copier.Ext:
+        return options
+    header = run(['dumpe2fs', '-h', partition['dev']], echo=False, timeout=cfg.CommandTimeout)
+    fields = dict((k.strip(), v.strip()) for k, v in (line.split(':', 1) for line in header.stdout.splitlines() if ':' in line))
+    if header.code or 'Inode count' not in fields:
+        return options
+    inodes, used = int(fields['Inode count']), int(fields['Inode count']) - int(fields['Free inodes'])
+    ratio = int(fields['Block count']) * int(fields['Block size']) / inodes
+    count = max(int(partition['size'] * 1048576 / ratio), int(used * cfg.ExpandFactor) + 16)
+    options += ['-b', fields['Block size'], '-N', count]
+    if features:
+        copied = [f for f in fields.get('Filesystem features', '').split() if f not in TransientFeatures]
+        options += ['-O', ','.join(['none'] + copied)]
+    return options + (['-I', fields['Inode size']] if 'Inode size' in fields else [])
 
 
 if __name__ == '__main__':
@@ -13,12 +13,19 @@
 
 import argparse
 import threading
+import time
 import config as cfg
 import aws
+import fleet
+import journal
 import linux
+import throttle
+import timeline
 
 
 reducedGB = 0  # 总共缩减的容量
+capacity = 0  # 同时缩容的磁盘数
+slots = None  # 空闲槽位，每块盘占一个槽位，即本机源盘和新盘两个设备
 
 
 # 设置命令行参数解析格式
@@ -32,6 +39,22 @@ def args_parser():
     parser.add_argument('-o', '--omit', action='append', help='omit AMI|EC2|Snapshot|Boot disk',
                         metavar='a|e|s|b', choices=['a', 'e', 's', 'b'])
     parser.add_argument('-m', '--master', action='store_true', help='master node for parallel processing')
+    parser.add_argument('-W', '--worker', action='store_true',
+                        help='worker node, keep shrinking EC2s tagged ShrinkingBy=this instance until idle')
+    parser.add_argument('-n', '--incremental', action='store_true',
+                        help='copy from snapshots while EC2 keeps running, stop it only for the final delta sync')
+    parser.add_argument('-B', '--block', action='store_true',
+                        help='block copy ext partitions shrunk by resize2fs -M, for snapshot/AMI or with -n')
+    parser.add_argument('-H', '--hydrate', action='store_true',
+                        help='prefetch used blocks of volumes restored from snapshots in parallel while copying')
+    parser.add_argument('-P', '--boost', action='store_true',
+                        help='create new volumes as high performance gp3 for copying, modify back when copied')
+    parser.add_argument('--mkfs', choices=sorted(cfg.MkfsProfiles), default=cfg.MkfsProfile,
+                        help='profile for making file systems on new volumes, default %s' % cfg.MkfsProfile)
+    parser.add_argument('-c', '--capacity', type=int, default=cfg.RepCapacity, metavar='N',
+                        help='volumes shrunk concurrently, default by attachment limit of this instance')
+    parser.add_argument('-w', '--workers', type=int, default=cfg.CopyWorkers, metavar='N',
+                        help='parallel rsync workers per partition, default %d' % cfg.CopyWorkers)
     args = parser.parse_args()
     filters = {}
     for filter_ in args.filters:
@@ -43,31 +66,88 @@ def args_parser():
 
     args.filters = [dict(Name=name, Values=list(values)) for name, values in filters.items()]
     args.omit = set(args.omit) if args.omit else set()
+    cfg.CopyWorkers = max(args.workers, 1)
+    cfg.MkfsProfile = args.mkfs
+    cfg.RepCapacity = max(args.capacity, 0)
 
     return args
 
 
-# 对cfg.volumeRepository中来源于EC2或快照的EBS盘进行缩容，并挂回/启动原EC2
-def shrink():
-    global reducedGB
-    # 创建线程池
-    msg = ['%s on %s %s%s' % (v['origin'].id, v.get('state', ''),
-                              v['instance'].id if v.get('instance', '') else 'snapshot',
-                              v.get('dev', '')) for v in cfg.volumeRepository]
-    cfg.log.info('===Begin shrinking for %s' % msg)
-    for idx, volume in enumerate(cfg.volumeRepository):
-        try:
-            if not linux.attach(idx):
-                continue
-            linux.fdisk(idx + cfg.RepCapacity, volume['partitions'])
-            task = threading.Thread(target=linux.shrink, args=(idx,))
-            volume['task'] = task
-            # linux.shrink(idx)
-            task.start()
-        except Exception as err:
-            cfg.log.error('Exception occurred, %s failed to shrink.' % volume['origin'].id)
-            cfg.log.exception(err)
+# 按本机可挂载的磁盘数确定并发数，每块盘同时占用源盘和新盘两个挂载位
+def setup():
+    global capacity, slots
+    try:
+        used, free = aws.attachment_capacity()
+        capacity = min(free, len(linux.DeviceNames) - len(used)) // 2
+    except Exception as err:
+        cfg.log.warning('Unable to get attachment limit of %s, %s' % (cfg.instance['instanceType'], err))
+        used, capacity = [], 6
+    capacity = min(capacity, cfg.RepCapacity) if cfg.RepCapacity else capacity
+    capacity = max(capacity, 1)
+    aws.setup(capacity)  # 按并发数重建客户端连接池
+    linux.setup_devices(used)
+    slots = threading.Semaphore(capacity)
+    journal.setup()
+    cfg.log.info('%s(%s) shrinks %d volumes concurrently' %
+                 (cfg.instance['instanceId'], cfg.instance['instanceType'], capacity))
+
+
+# 等到有空闲槽位就立即开始缩容一块盘，不必等待同批其他盘完成
+def submit(volume, held=False):
+    """
+    :param volume: cfg.volumeRepository中的磁盘，调用前须已加入仓库，以便同机磁盘互相可见
+    :param held: 调用方已为该盘占好槽位
+    """
+    None if held else slots.acquire()
+    volume['devices'] = dict(source=linux.alloc_device(), dup=linux.alloc_device())
+    cfg.log.info('===Begin shrinking for %s on %s' % (volume['origin'].id, where(volume)))
+    task = threading.Thread(target=run, args=(volume,))
+    volume['task'] = task
+    task.start()
+
+
+# 缩容线程：挂盘估算、建新盘、分区后复制数据，完成后归还槽位
+# 各盘的准备过程在各自线程中进行，互相重叠，也与已开始的复制重叠
+def run(volume):
+    timeline.bind(volume=volume['origin'].id, instance=source(volume))
+    try:
+        if volume.get('stage', '') == 'restored':  # 快照缩容的盘异步恢复，在本线程等待可用
+            aws.wait_restored(volume)
+        if 'barrier' in volume:  # 两阶段缩容，先从快照恢复临时盘
+            aws.seed_volume(volume)
+            journal.save(volume, 'seeded')
+        if volume.get('stage', '') in journal.Resumable:  # 续做，新盘已分区
+            linux.reattach(volume)
+        else:
+            if not linux.attach(volume):
+                return
+            linux.fdisk(volume['devices']['dup'], volume['partitions'])
+            journal.save(volume, 'partitioned')
+        linux.shrink(volume)
+    except Exception as err:
+        cfg.log.error('Exception occurred, %s failed to shrink.' % volume['origin'].id)
+        cfg.log.exception(err)
+        if not volume.get('result', ''):  # 删除未用上的新盘，原盘挂回
+            for step in (linux.umount_all, aws.drop_dup, aws.wind_up):
+                try:
+                    step(volume)
+                except Exception as err:
+                    cfg.log.exception(err)
+    finally:
+        linux.umount_all(volume)
+        if 'barrier' in volume:  # 没走到停机点的盘也要报到，以免同机其他盘一直等待
+            try:
+                volume.pop('barrier').wait()
+            except threading.BrokenBarrierError:
+                pass
+        for device in volume['devices'].values():
+            linux.release_device(device)
+        slots.release()
+
 
+# 等待仓库中所有磁盘完成，汇总缩容结果
+def drain():
+    global reducedGB
     msg = '\n'
     for volume in cfg.volumeRepository:
         if 'task' in volume:
@@ -79,69 +159,192 @@ def shrink():
         else:
             size, result = 0, 'NoShrink'
         reducedGB += size
-        instance_id = volume['instance'].id if volume.get('instance', '') else 'snapshot'
-        msg += '%s[%s] on %s %s%s\n' % (origin.id, result, volume.get('state', ''), instance_id, volume.get('dev', ''))
+        msg += '%s[%s] on %s\n' % (origin.id, result, where(volume))
     cfg.log.info('===End shrinking for %s' % msg)
 
     cfg.volumeRepository = []  # 清空缩盘库
 
 
+# 磁盘来源描述，用于日志
+def where(volume):
+    return '%s %s%s' % (volume.get('state', ''), source(volume), volume.get('dev', ''))
+
+
+def source(volume):
+    if volume.get('instance', ''):
+        return volume['instance'].id
+    return volume['image'].id if volume.get('image', '') else 'snapshot'
+
+
+# AMI各盘的快照直接恢复为盘缩容，同一AMI的盘都完成后注册新AMI，多个AMI的盘同时在槽位中处理
 def shrink_images():
-    instances = []
     for image in aws.get_images():
-        instance = aws.image2instance(image.id)
-        if not aws.stop_instance(instance, interactive=False):
-            instance.terminate()
-            cfg.log.error('[FAILED]%s from %s failed to stop, ignore shrinking...' % (instance.id, image.id))
+        volumes = aws.image2volumes(image)
+        if not volumes:
             continue
-        instances.append(instance)
-        volumes = aws.get_instance_volumes(instance)
-        if len(cfg.volumeRepository) + len(volumes) >= cfg.RepCapacity:
-            shrink()
-        aws.detach_volumes(volumes, tags=[dict(Key='AMI', Value=image.id)])
-        cfg.volumeRepository += volumes
-    shrink()
+        for volume in volumes:
+            journal.save(volume, 'restored')
+        cfg.volumeRepository += volumes  # 同一AMI的盘一起入库，以便判断是否都已完成
+        for volume in volumes:
+            submit(volume)
+    drain()
+    for thread in aws.registrations:  # 等待新AMI注册完成
+        thread.join()
 
-    for instance in instances:
-        instance.terminate()
-        cfg.log.info('%s(tmp for AMI) terminated.' % instance.id)
 
+# 两阶段缩容：实例不停机先从快照复制全量，同机各盘全量都完成后再停机，只同步增量
+def presync(instance, volumes):
+    state = instance.state['Name']
+    if cfg.args.interactive and input('%s is %s, Stop it after presync for shrinking? <Y>  ' %
+                                      (instance.id, state)) not in cfg.YES:
+        print('shrink for %s is skipped...\n' % instance.id)
+        return
+    barrier = threading.Barrier(len(volumes), action=lambda: aws.stop_for_delta(instance, volumes))
+    for volume in volumes:
+        volume.update(barrier=barrier, detached=False)
+        journal.save(volume, 'seeding')
+    cfg.volumeRepository += volumes
+    for volume in volumes:
+        submit(volume)
 
-def shrink_ec2s():
-    for instance in aws.get_instances():
+
+def shrink_ec2s(instances=None):
+    for instance in instances if instances is not None else aws.get_instances():
         volumes = aws.get_instance_volumes(instance)
-        if len(cfg.volumeRepository) + len(volumes) >= cfg.RepCapacity:
-            shrink()
+        # 同机各盘要同时占用槽位才能一起到达停机点
+        if cfg.args.incremental and instance.state['Name'] == 'running' and 0 < len(volumes) <= capacity:
+            presync(instance, volumes)
+            continue
+        held = min(len(volumes), capacity)  # 先占好槽位再停机，以免停机后长时间等待槽位
+        for _ in range(held):
+            slots.acquire()
+        for volume in volumes:  # 停机、摘盘过程中中断的，续做时恢复原机
+            volume['detached'] = False
+            journal.save(volume, 'stopping')
         if not aws.stop_instance(instance, interactive=cfg.args.interactive):
             cfg.log.error('[FAILED]%s failed to stop, ignore shrinking...' % instance.id)
+            for volume in volumes:
+                journal.finish(volume)
+            for _ in range(held):
+                slots.release()
             continue
+        for volume in volumes:
+            volume['detached'] = True
         aws.detach_volumes(volumes)
+        for volume in volumes:
+            journal.save(volume, 'detached')
         cfg.volumeRepository += volumes
-    shrink()
+        for idx, volume in enumerate(volumes):
+            submit(volume, held=idx < held)
+    drain()
 
 
 def shrink_snapshots():
     for volume in aws.snapshot2volume():
+        journal.save(volume, 'restored')
         cfg.volumeRepository.append(volume)
-        if len(cfg.volumeRepository) >= cfg.RepCapacity:
-            shrink()
-    shrink()
+        submit(volume)
+    drain()
+
+
+# 续做上次中断的缩容：已分区的新盘从原盘增量同步，其余的删掉临时盘和新盘后从头缩容
+def resume():
+    volumes, stopping = [], {}
+    for volume in journal.load():
+        try:
+            aws.drop_seed(volume)
+            if not volume['detached'] and volume['stage'] == 'stopping':  # 停机摘盘中断，原机可能已停，稍后同机一起恢复
+                aws.drop_dup(volume)
+                stopping.setdefault(volume['instance'], []).append(volume)
+                continue
+            if not volume['detached']:  # 两阶段缩容未到停机点，原机仍挂着原盘运行，下次再缩
+                aws.drop_dup(volume)
+                journal.finish(volume)
+                continue
+            if volume.get('image', ''):  # AMI未能注册新镜像，删掉恢复的盘，下次从快照重做
+                aws.drop_dup(volume)
+                aws.detach__volume(volume['origin'])
+                volume['origin'].delete()
+                journal.finish(volume)
+                continue
+            if not journal.resumable(volume):  # 从头缩容
+                aws.drop_dup(volume)
+                volume['partitions'] = []
+                journal.save(volume, 'detached' if volume['stage'] in journal.Resumable else None)
+            volumes.append(volume)
+        except Exception as err:
+            cfg.log.error('Unable to resume %s, please check it manually.' % volume['origin'].id)
+            cfg.log.exception(err)
+    for instance, items in stopping.items():
+        try:
+            aws.recover_stopping(instance, items)
+            for volume in items:
+                journal.finish(volume)
+        except Exception as err:
+            cfg.log.error('Unable to recover %s, please check it manually.' % instance.id)
+            cfg.log.exception(err)
+    if not volumes:
+        return
+    cfg.log.info('===Resuming %d volumes interrupted last time' % len(volumes))
+    cfg.volumeRepository += volumes
+    for volume in volumes:
+        submit(volume)
+    drain()
+
+
+# 常驻工作节点：领取控制节点用ShrinkingBy标签分派给本机的实例，空闲超过cfg.WorkerIdle秒后退出
+# 退出前先标记即将关机，再等一个查询间隔确认没有刚分派来的任务，控制节点分派后也会检查该标记
+def work():
+    me, idle = cfg.instance['instanceId'], time.time()
+    cfg.log.info('===%s is waiting for jobs===' % me)
+    cfg.args.filters = [dict(Name='tag:ShrinkingBy', Values=[me])]
+    while True:
+        instances = list(aws.get_instances())
+        if not instances and time.time() - idle < cfg.WorkerIdle:
+            time.sleep(cfg.WorkerPoll)
+            continue
+        if not instances:
+            fleet.set_draining(me, True)
+            time.sleep(cfg.WorkerPoll)
+            instances = list(aws.get_instances())
+            if not instances:
+                break
+            fleet.set_draining(me, False)
+        shrink_ec2s(instances)
+        for instance in instances:
+            instance.delete_tags(Tags=[dict(Key='ShrinkingBy')])
+            instance.create_tags(Tags=[dict(Key='ShrinkedBy', Value=me)])
+        idle = time.time()
+    cfg.log.info('===%s has been idle for %ds, exiting===' % (me, cfg.WorkerIdle))
 
 
 if __name__ == '__main__':
     cfg.setup(args_parser())
     aws.setup()
+    setup()
 
     if cfg.args.master and 'e' not in cfg.args.omit:  # master node for parallel process of shrinking EC2
-        aws.master()
+        fleet.master()
+        exit(0)
+    resume()  # 先续做上次中断的缩容
+    if cfg.args.worker:
+        work()
         exit(0)
 
-    if 'a' not in cfg.args.omit:  # AMI
-        shrink_images()
-    if 'e' not in cfg.args.omit:  # EC2
-        shrink_ec2s()
-    if 's' not in cfg.args.omit:  # Snapshot
-        shrink_snapshots()
+    try:
+        if 'a' not in cfg.args.omit:  # AMI
+            shrink_images()
+        if 'e' not in cfg.args.omit:  # EC2
+            shrink_ec2s()
+        if 's' not in cfg.args.omit:  # Snapshot
+            shrink_snapshots()
+    except KeyboardInterrupt:  # 结束运行中的命令，各线程随之失败并挂回原盘
+        linux.cancel()
+        raise
+    finally:
+        linux.report_timings()
+        throttle.report()
+        timeline.dump()
 
     if reducedGB:
         cfg.log.info('TOTALLY reduced %dGB Storage!' % reducedGB)
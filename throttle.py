@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @File  : throttle.py
+# @Author: Bai Yanzheng
+# @Date  : 2026/10/18
+# @Desc  : EC2 API限流，所有线程共用
+# 按API类别(查询、变更、标签)各一个令牌桶，每次调用及每次被限流后的重试前领取令牌；
+# 被限流(RequestLimitExceeded)时该类别速率减半，之后每次成功调用逐步恢复到配置速率。
+# 通过botocore事件挂到客户端上，调用方无需改动；统计各类别调用、限流、重试次数
+#
+
+import threading
+import time
+
+import config as cfg
+
+Throttles = ('RequestLimitExceeded', 'Throttling', 'ThrottlingException')
+MinRate = 0.5  # 限流后速率下限(次/秒)
+
+buckets = {}  # {category: dict(burst=, max=, rate=, tokens=, time=)}
+counters = {}  # {category: dict(calls=, throttles=, retries=, waited=)}
+lock = threading.Lock()
+
+
+def setup():
+    now = time.time()
+    with lock:
+        for name, (burst, rate) in cfg.ApiRates.items():
+            buckets.setdefault(name, dict(burst=burst, max=rate, rate=rate, tokens=burst, time=now))
+            counters.setdefault(name, dict(calls=0, throttles=0, retries=0, waited=0.0))
+
+
+# 挂到boto3客户端上
+def register(client):
+    events = client.meta.events
+    events.register('before-call.ec2', before_call)
+    events.register('needs-retry.ec2', needs_retry)
+    events.register('after-call.ec2', after_call)
+
+
+# API类别，与EC2的限流分类大致对应
+def category(operation):
+    if operation in ('CreateTags', 'DeleteTags'):
+        return 'tags'
+    if operation.startswith(('Describe', 'Get', 'List')):
+        return 'describe'
+    return 'mutate'
+
+
+# 领取一个令牌，不足时预支并等待到令牌补足
+def acquire(name):
+    with lock:
+        bucket, now = buckets[name], time.time()
+        bucket['tokens'] = min(bucket['burst'], bucket['tokens'] + (now - bucket['time']) * bucket['rate'])
+        bucket['time'] = now
+        bucket['tokens'] -= 1
+        wait = -bucket['tokens'] / bucket['rate'] if bucket['tokens'] < 0 else 0
+        counters[name]['calls'] += 1
+        counters[name]['waited'] += wait
+    time.sleep(wait) if wait else None
+
+
+def before_call(model, **kwargs):
+    acquire(category(model.name))
+
+
+# 被限流：降低该类别速率，重试前再领令牌；是否重试由botocore的重试策略决定
+def needs_retry(response=None, operation=None, **kwargs):
+    parsed = response[1] if response else {}
+    if (parsed or {}).get('Error', {}).get('Code', '') not in Throttles:
+        return None
+    name = category(operation.name)
+    with lock:
+        bucket = buckets[name]
+        bucket['rate'] = max(MinRate, bucket['rate'] / 2)
+        counters[name]['throttles'] += 1
+    cfg.log.warning('%s throttled, %s API rate lowered to %.1f/s' % (operation.name, name, bucket['rate']))
+    acquire(name)
+    return None
+
+
+# 调用结束：累计重试次数，成功时速率逐步恢复；botocore对失败的调用也先发此事件再抛出异常
+def after_call(http_response, parsed, model, **kwargs):
+    name = category(model.name)
+    with lock:
+        bucket = buckets[name]
+        counters[name]['retries'] += parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+        if http_response.status_code < 300:
+            bucket['rate'] = min(bucket['max'], bucket['rate'] + bucket['max'] / 20)
+
+
+# 记录各类别API调用统计
+def report():
+    for name, counter in sorted(counters.items()):
+        if counter['calls']:
+            cfg.log.info('%s API: %d calls, %d throttled, %d retries, %.1fs waited for tokens' %
+                         (name, counter['calls'], counter['throttles'], counter['retries'], counter['waited']))
+
+
+if __name__ == '__main__':
+    pass
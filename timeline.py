@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @File  : timeline.py
+# @Author: Bai Yanzheng
+# @Date  : 2026/10/18
+# @Desc  : 记录每块盘、每台实例各阶段的耗时及实例停机时长
+# 运行结束时导出Chrome trace(chrome://tracing可打开)和按阶段的分位数汇总，
+# 汇总同时以statsd指标发给本机CloudWatch Agent
+#
+
+import contextlib
+import json
+import os
+import socket
+import threading
+import time
+
+import config as cfg
+
+TraceFile = 'shrink.trace.json'
+SummaryFile = 'shrink.summary.json'
+
+events = []  # [dict(name=, start=, end=, thread=, args=)]
+downs = {}  # {instance_id: 停机时间}
+lock = threading.Lock()
+local = threading.local()
+
+
+# 给当前线程绑定上下文，如volume、instance，之后的span都带上
+def bind(**attrs):
+    local.attrs = attrs
+
+
+def record(name, start, end, **attrs):
+    args = dict(getattr(local, 'attrs', {}), **attrs)
+    with lock:
+        events.append(dict(name=name, start=start, end=end, thread=threading.current_thread().name, args=args))
+
+
+# 记录一个阶段，可用作with语句或函数修饰器
+@contextlib.contextmanager
+def span(name, **attrs):
+    start = time.time()
+    try:
+        yield
+    finally:
+        record(name, start, time.time(), **attrs)
+
+
+# 实例停机开始
+def down(instance_id):
+    with lock:
+        downs.setdefault(instance_id, time.time())
+
+
+# 实例重新启动，记录停机时长
+def up(instance_id):
+    with lock:
+        start = downs.pop(instance_id, None)
+    if start:
+        record('downtime', start, time.time(), instance=instance_id)
+
+
+# 按阶段汇总耗时分位数
+def summary():
+    durations = {}
+    with lock:
+        for event in events:
+            durations.setdefault(event['name'], []).append(event['end'] - event['start'])
+    result = {}
+    for name, values in durations.items():
+        values.sort()
+        result[name] = dict(count=len(values), total=sum(values), max=values[-1],
+                            **{'p%d' % p: values[min(len(values) - 1, int(len(values) * p / 100))]
+                               for p in (50, 90, 99)})
+    return result
+
+
+# 导出trace和汇总，汇总写入日志并发给CloudWatch Agent
+def dump():
+    with lock:
+        trace = [dict(name=e['name'], cat='shrink', ph='X', pid=1, tid=e['thread'], args=e['args'],
+                      ts=int(e['start'] * 1e6), dur=int((e['end'] - e['start']) * 1e6)) for e in events]
+    if not trace:
+        return
+    with open(os.path.join(cfg.WorkPath, TraceFile), 'w', encoding='utf-8') as fp:
+        json.dump(dict(traceEvents=trace, displayTimeUnit='ms'), fp)
+    result = summary()
+    with open(os.path.join(cfg.WorkPath, SummaryFile), 'w', encoding='utf-8') as fp:
+        json.dump(result, fp, indent=2)
+    for name, stats in sorted(result.items(), key=lambda item: item[1]['total'], reverse=True):
+        cfg.log.info('%s: %d times, total %.1fs, p50 %.1fs, p90 %.1fs, p99 %.1fs, max %.1fs' %
+                     (name, stats['count'], stats['total'], stats['p50'], stats['p90'], stats['p99'], stats['max']))
+    send(result)
+
+
+# 以statsd gauge发送汇总，CloudWatch Agent未开statsd时丢弃
+def send(result):
+    try:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        for name, stats in result.items():
+            for key in ('p50', 'p90', 'p99', 'max'):
+                metric = 'shrink.%s.%s:%.3f|g' % (name, key, stats[key])
+                sock.sendto(metric.encode('utf-8'), cfg.StatsdAddress)
+        sock.close()
+    except OSError as err:
+        cfg.log.warning('Unable to send metrics to %s: %s' % (cfg.StatsdAddress, err))
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @File  : waiter.py
+# @Author: Bai Yanzheng
+# @Date  : 2026/10/18
+# @Desc  : 集中等待EC2磁盘/实例/快照状态变化
+# 所有线程的等待请求汇总到一个轮询线程，每轮每类资源只发一次带过滤条件的Describe，
+# 满足条件时完成对应的Future，并用返回结果刷新资源对象，免去调用方再load
+#
+
+import threading
+import time
+from concurrent.futures import Future, TimeoutError
+
+import aws
+import config as cfg
+
+MaxFilterValues = 200  # 单个Filter允许的取值个数上限
+
+lock = threading.Lock()
+pending = dict(volume={}, instance={}, snapshot={})  # {kind: {resource_id: [(resource, predicate, future)]}}
+poller = None
+
+
+def describe_volumes(ids):
+    paginator = aws.client_ec2.get_paginator('describe_volumes')
+    for page in paginator.paginate(Filters=[dict(Name='volume-id', Values=ids)]):
+        for volume in page['Volumes']:
+            yield volume['VolumeId'], volume
+
+
+def describe_instances(ids):
+    paginator = aws.client_ec2.get_paginator('describe_instances')
+    for page in paginator.paginate(Filters=[dict(Name='instance-id', Values=ids)]):
+        for reservation in page['Reservations']:
+            for instance in reservation['Instances']:
+                yield instance['InstanceId'], instance
+
+
+def describe_snapshots(ids):
+    paginator = aws.client_ec2.get_paginator('describe_snapshots')
+    for page in paginator.paginate(Filters=[dict(Name='snapshot-id', Values=ids)]):
+        for snapshot in page['Snapshots']:
+            yield snapshot['SnapshotId'], snapshot
+
+
+Describe = dict(volume=describe_volumes, instance=describe_instances, snapshot=describe_snapshots)
+
+
+# 登记一个等待，返回Future，状态满足predicate时以Describe结果完成
+def watch(kind, resource, predicate):
+    """
+    :param kind: volume|instance
+    :param resource: boto3 Volume/Instance对象
+    :param predicate: 函数，参数为Describe返回的该资源字典，返回True表示等待结束
+    :return: Future
+    """
+    global poller
+    future = Future()
+    with lock:
+        pending[kind].setdefault(resource.id, []).append((resource, predicate, future))
+        if not poller or not poller.is_alive():
+            poller = threading.Thread(target=poll, name='waiter', daemon=True)
+            poller.start()
+    return future
+
+
+# 取消等待
+def unwatch(kind, resource, future):
+    with lock:
+        waiters = [w for w in pending[kind].get(resource.id, []) if w[2] is not future]
+        if waiters:
+            pending[kind][resource.id] = waiters
+        else:
+            pending[kind].pop(resource.id, None)
+
+
+# 等待资源满足predicate，超时返回False
+def wait(kind, resource, predicate, timeout=None):
+    future = watch(kind, resource, predicate)
+    try:
+        future.result(timeout or cfg.TIMEOUT)
+        return True
+    except TimeoutError:
+        unwatch(kind, resource, future)
+        return False
+
+
+def wait_volume(volume, predicate, timeout=None):
+    return wait('volume', volume, predicate, timeout)
+
+
+def wait_instance(instance, predicate, timeout=None):
+    return wait('instance', instance, predicate, timeout or cfg.InstanceTimeout)
+
+
+def wait_snapshot(snapshot, predicate, timeout=None):
+    return wait('snapshot', snapshot, predicate, timeout or cfg.SnapshotTimeout)
+
+
+# 常用的状态判断
+def volume_state(state):
+    return lambda data: data['State'] == state
+
+
+def volume_attached(data):
+    return bool(data['Attachments']) and data['Attachments'][0]['State'] == 'attached'
+
+
+def instance_state(state):
+    return lambda data: data['State']['Name'] == state
+
+
+def snapshot_state(state):
+    return lambda data: data['State'] == state
+
+
+# 轮询线程：每个周期对所有等待中的资源批量Describe一次
+def poll():
+    while True:
+        time.sleep(cfg.PollInterval)
+        with lock:
+            snapshot = {kind: {rid: list(waiters) for rid, waiters in resources.items()}
+                        for kind, resources in pending.items()}
+        for kind, resources in snapshot.items():
+            ids = list(resources.keys())
+            for i in range(0, len(ids), MaxFilterValues):
+                try:
+                    results = list(Describe[kind](ids[i:i + MaxFilterValues]))
+                except Exception as err:
+                    cfg.log.warning('Describe %ss failed: %s' % (kind, err))
+                    continue
+                for rid, data in results:
+                    for resource, predicate, future in resources.get(rid, []):
+                        resource.meta.data = data  # 刷新资源属性
+                        if predicate(data):
+                            unwatch(kind, resource, future)
+                            future.set_result(data)
+
+
+if __name__ == '__main__':
+    pass